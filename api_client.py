@@ -0,0 +1,210 @@
+import time
+import queue
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from request_retry import request_not_sent
+
+# (connect, read) timeout in seconds; large surroundings uploads can take a while to be answered
+DEFAULT_TIMEOUT = (10, 300)
+DEFAULT_POOL_SIZE = 10
+# paths that are not tables, requests to them do not invalidate cached reads
+NON_TABLE_PATHS = ('oauth',)
+
+# server address -> ApiClient
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+class ApiClient:
+    """
+    Keep-alive client for the Leaftech API. All requests to one server go through a single requests.Session, so the
+    TCP and TLS connections are pooled and reused instead of being opened again for every item. The access token is
+    passed per request, as one server is used with the tokens of different users.
+    """
+
+    def __init__(self, server_address, timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE):
+        """
+        :param server_address: hostname of the environment, e.g. https://leaftech-api.dev1.secu-ring.de/api/
+        :param timeout: (connect, read) timeout in seconds used when a request does not give its own.
+        :param pool_size: Number of connections kept open to the server.
+        """
+        self.base_url = server_address.replace('\\', '/').rstrip('/') + '/'
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # table path -> number of writes to the table done through this client, used to invalidate cached reads
+        self.generations = {}
+        self._generations_lock = threading.Lock()
+
+    def url(self, *path):
+        """
+        Joins the path parts to the base url, e.g. url('surroundings/buildings', 12) -> <base>/surroundings/buildings/12
+        """
+        return self.base_url + '/'.join(str(part).replace('\\', '/').strip('/') for part in path)
+
+    def request(self, method, *path, access_token=None, params=None, data=None, json_body=False, timeout=None,
+                headers=None):
+        """
+        :param method: HTTP method, e.g. "GET".
+        :param path: Parts of the path below the base url (table path, item id).
+        :param access_token: Bearer token of the user, no Authorization header if None.
+        :param params: Query parameters, encoded by requests.
+        :param data: Request body, a json string or a form dictionary.
+        :param json_body: Sends the body with the application/json content type.
+        :param timeout: Overrides the timeout of the client for this request.
+        :param headers: Additional headers.
+        :return response: The requests.Response object.
+        """
+        request_headers = {}
+        if access_token is not None:
+            request_headers['Authorization'] = 'Bearer %s' % access_token
+        if json_body:
+            request_headers['Content-Type'] = 'application/json'
+        if headers:
+            request_headers.update(headers)
+        response = self.session.request(method, self.url(*path), headers=request_headers, params=params, data=data,
+                                        timeout=self.timeout if timeout is None else timeout)
+        if method != "GET" and path and 200 <= response.status_code < 300:
+            table_path = str(path[0]).replace('\\', '/').strip('/')
+            if table_path not in NON_TABLE_PATHS:
+                self.invalidate(table_path)
+        return response
+
+    def table_generation(self, table_path):
+        return self.generations.get(table_path.replace('\\', '/').strip('/'), 0)
+
+    def invalidate(self, table_path):
+        """
+        Marks every cached read of a table as outdated. Called for every successful request that changes the table.
+        """
+        key = table_path.replace('\\', '/').strip('/')
+        with self._generations_lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    def get(self, *path, **kwargs):
+        return self.request("GET", *path, **kwargs)
+
+    def post(self, *path, **kwargs):
+        return self.request("POST", *path, json_body=True, **kwargs)
+
+    def patch(self, *path, **kwargs):
+        return self.request("PATCH", *path, json_body=True, **kwargs)
+
+    def delete(self, *path, **kwargs):
+        return self.request("DELETE", *path, json_body=True, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_client(server_address):
+    """
+    Returns the shared client of a server, created on first use.
+    :param server_address: hostname of the environment.
+    :return: ApiClient of the server.
+    """
+    key = server_address.replace('\\', '/').rstrip('/')
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = ApiClient(server_address)
+            _CLIENTS[key] = client
+    return client
+
+
+class ConcurrentUploader:
+    """
+    Uploads items in the background with a pool of worker threads, so the caller (e.g. the GML parser) does not wait
+    for the network. Items are fed through a bounded queue: submit() blocks while the queue is full, which keeps the
+    producer from running far ahead of the uploads. A POST creates an item, so an upload is only retried, with
+    exponential backoff and random jitter, if its request could not be sent at all; after a timeout or a 5xx response
+    the server may have stored the item already and it is reported as failed instead of being posted twice.
+
+    with ConcurrentUploader(server_address, access_token) as uploader:
+        uploader.submit("surroundings/buildings", payload_json, name)
+    print(uploader.report)
+    """
+
+    def __init__(self, server_address, access_token, workers=8, queue_size=64, retries=3, backoff=0.5):
+        """
+        :param server_address: hostname of the environment where we post the data.
+        :param access_token: contains the security credentials for a login session.
+        :param workers: Number of concurrent uploads.
+        :param queue_size: Number of items that may wait for a worker before submit() blocks.
+        :param retries: Number of retries of an upload whose request could not be sent.
+        :param backoff: Seconds to wait before the first retry, doubled for every further retry.
+        """
+        self.client = get_client(server_address)
+        self.access_token = access_token
+        self.retries = retries
+        self.backoff = backoff
+        self.report = {}
+        self._report_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, table_path, payload_json, name=None):
+        """
+        Queues one POST of payload_json to table_path. Blocks while the queue is full.
+        :param name: Key of the item in the report, e.g. the building name.
+        """
+        self._queue.put((table_path, payload_json, name))
+
+    def _upload(self, table_path, payload_json):
+        status_code = None
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                response = self.client.post(table_path, access_token=self.access_token, data=payload_json)
+            except requests.exceptions.RequestException as request_error:
+                status_code, error = None, str(request_error)
+                if request_not_sent(request_error):
+                    continue
+                break
+            status_code = response.status_code
+            error = response.text[:500] if status_code >= 400 else None
+            break
+        return {"uploaded": status_code in (200, 201), "status_code": status_code, "error": error}
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            table_path, payload_json, name = item
+            try:
+                result = self._upload(table_path, payload_json)
+            except Exception as error:
+                result = {"uploaded": False, "status_code": None, "error": str(error)}
+            with self._report_lock:
+                self.report[name] = result
+            self._queue.task_done()
+
+    def close(self):
+        """
+        Waits until every queued item is uploaded and stops the workers.
+        :return report: Dictionary name -> {"uploaded": bool, "status_code": int or None, "error": str or None}.
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        return self.report
+
+    def failed(self):
+        return [name for name, result in self.report.items() if not result["uploaded"]]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
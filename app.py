@@ -5,10 +5,11 @@ from werkzeug.exceptions import abort
 from werkzeug.utils import secure_filename
 from app_functions import manual_stl_download, automatic_stl_download, geo_data_download, \
     setup_project, get_menu_checklist, return_config_dict, write_config_dict, select_geo_template, \
-    return_building_dict, write_building_dict, obtain_token, get_request, customer_setup, \
-    project_setup, read_json_files, get_relevant_data, get_unique_layers, post_terrain_objects_cloud, \
-    poisson_mesh_triangulation, building_utm_center, triangle_norming, export_stl, split_gml_cloud, \
-    remove_overlapping_sb, triangulate_static_shading_influences_cloud, get_object_d_vegetation
+    return_building_dict, write_building_dict, obtain_token, iter_get_request, customer_setup, \
+    project_setup, read_json_files, get_relevant_data, get_unique_layers, geodata_perimeter, \
+    post_terrain_objects_cloud, poisson_mesh_triangle_array, building_utm_center, export_stl_array, \
+    export_buildings_stl, split_gml_cloud, remove_overlapping_sb, triangulate_static_shading_influences_cloud, \
+    get_object_d_vegetation, get_kml_file_path
 
 projects_list = []
 folder_name = 'folder'
@@ -58,8 +59,7 @@ def login_page():
         access_token = obtain_token(credentials_d, selected_environment)
 
         if access_token:
-            projects = get_request(
-                selected_environment, access_token, 'projects', limit=10000)['list']
+            projects = iter_get_request(selected_environment, access_token, 'projects')
             projects_list = [project['name'] for project in projects]
             return render_template('setup_2_0.html', project_list=projects_list, error=False)
         else:
@@ -238,17 +238,16 @@ def acquire_geodata_download():
         project_folder, 'DigitalTwin', 'config'))
     category_d = read_json_files(CATEGORY_DICT)
     county = config_file['County']
-    kml_file = os.listdir(os.path.join(project_folder, 'GeospatialData', 'KML'))
-    kml_file_path = os.path.join(
-        project_folder, 'GeospatialData', 'KML', kml_file[0])
+    kml_file_path = get_kml_file_path(project_folder)
 
     tb_center, pts_bldgs, pts_veg, pts_terrain, object_d_veg, target_shape, target_area_shape, target_area_center = \
         get_relevant_data(kml_file_path, category_d)
 
     unique_list_layers = get_unique_layers(
         county, pts_bldgs, pts_veg, pts_terrain)
+    perimeter = geodata_perimeter(tb_center, [pts_bldgs, pts_veg, pts_terrain])
     # files download, dependent on the county and the type of data that we download.
-    geo_data_download(project_folder, county, unique_list_layers)
+    geo_data_download(project_folder, county, unique_list_layers, perimeter=perimeter)
     return render_template('buildings_1_0.html')
 
 
@@ -261,10 +260,7 @@ def terrain_1_0():
     project_folder = destination_path
     category_d = read_json_files(CATEGORY_DICT)
 
-    kml_file = os.listdir(os.path.join(
-        project_folder, 'GeospatialData', 'KML'))
-    kml_file_path = os.path.join(
-        project_folder, 'GeospatialData', 'KML', kml_file[0])
+    kml_file_path = get_kml_file_path(project_folder)
 
     tb_center, pts_bldgs, pts_veg, pts_terrain, object_d_veg, target_shape, target_area_shape, target_area_center = \
         get_relevant_data(kml_file_path, category_d)
@@ -272,16 +268,15 @@ def terrain_1_0():
     # methods to generate terrain STL files
     alpha_shape_value = 0.04
     terrain_detail = 8
+    alpha_shape_workers = os.cpu_count()
     point_cloud_terrain = post_terrain_objects_cloud(selected_environment, access_token, project_folder, project_id,
-                                                     alpha_shape_value, tb_center, pts_terrain)
+                                                     alpha_shape_value, tb_center, pts_terrain, alpha_shape_workers)
 
-    triangle_list_terrain = poisson_mesh_triangulation(
-        point_cloud_terrain, terrain_detail, project_folder)
     utm_center = building_utm_center(
         selected_environment, access_token, project_id)
-    triangles_terrain_a_normed = triangle_norming(
-        triangle_list_terrain, utm_center)
-    export_stl(project_folder, triangles_terrain_a_normed, "Terrain")
+    triangles_terrain_a_normed = poisson_mesh_triangle_array(
+        point_cloud_terrain, terrain_detail, project_folder, utm_center)
+    export_stl_array(project_folder, triangles_terrain_a_normed, "Terrain")
 
     return render_template('trees_1_0.html')
 
@@ -300,46 +295,39 @@ def buildings_1_0():
     # methods to generate terrain STL files
     category_d = read_json_files(CATEGORY_DICT)
 
-    kml_file = os.listdir(os.path.join(
-        project_folder, 'GeospatialData', 'KML'))
-    kml_file_path = os.path.join(
-        project_folder, 'GeospatialData', 'KML', kml_file[0])
+    kml_file_path = get_kml_file_path(project_folder)
 
     tb_center, pts_bldgs, pts_veg, pts_terrain, object_d_veg, target_shape, target_area_shape, target_area_center = \
         get_relevant_data(kml_file_path, category_d)
 
+    upload_workers = 8
     split_gml_cloud(selected_environment, access_token, project_folder, project_id, county, tb_center,
-                    pts_bldgs, target_shape)
+                    pts_bldgs, target_shape, upload_workers)
     remove_overlapping_sb(selected_environment, access_token, project_id)
 
+    triangulation_workers = os.cpu_count()
     triangles_target_buildings_a = triangulate_static_shading_influences_cloud(
         project_folder,
         selected_environment,
         access_token,
         project_id,
-        'true')
+        'true',
+        triangulation_workers,
+        as_array=True)
     triangles_surrounding_buildings_a = triangulate_static_shading_influences_cloud(
         project_folder,
         selected_environment,
         access_token,
         project_id,
-        'false')
+        'false',
+        triangulation_workers,
+        as_array=True)
     utm_center = building_utm_center(
         selected_environment, access_token, project_id)
     config_file['Location'] = list(utm_center)
     write_config_dict(config_file, folder_name)
 
-    triangles_target_buildings_a_normed = triangle_norming(
-        triangles_target_buildings_a, utm_center)
-    triangles_surrounding_buildings_a_normed = triangle_norming(triangles_surrounding_buildings_a,
-                                                                utm_center)
-    triangles_buildings_a_normed = triangles_target_buildings_a_normed + \
-        triangles_surrounding_buildings_a_normed
-    export_stl(project_folder, triangles_target_buildings_a_normed,
-               "Target_Buildings")
-    export_stl(project_folder, triangles_surrounding_buildings_a_normed,
-               "Surrounding_Buildings")
-    export_stl(project_folder, triangles_buildings_a_normed, "Buildings")
+    export_buildings_stl(project_folder, triangles_target_buildings_a, triangles_surrounding_buildings_a, utm_center)
     return render_template('terrain_1_0.html')
 
 
@@ -2,27 +2,46 @@ import os
 import shutil
 from json import load, dumps
 import open3d as o3d
-from requests import request
 import numpy as np
 import requests
-from subprocess import call
 import time
 import gzip
+import hashlib
 import zipfile
 import json
 import utm
 import alphashape
-import ast
+import shapely
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from stl import mesh
-from shapely.geometry import Point, MultiPoint, Polygon
-from scipy.spatial import Delaunay
+from shapely.geometry import MultiPoint, Polygon
+from shapely.strtree import STRtree
+from shapely_compat import contains_xy
 from manual_tree_creation import random_tree_model_placement, selected_tree_model_placement
 from unique_list_coordinates import unique_list_coordinates
+from api_client import get_client, ConcurrentUploader
+from request_retry import request_not_sent
+from polygon_from_kml import polygon_from_kml
+from kml_scene_cache import cached_polygon_from_kml, get_kml_file_path
+from tile_store import open_layer, ingest_layer, ingest_points, read_xyz_stream, tile_store_folder, \
+    tile_store_path, tile_covers, TileIngestPool
+from tile_downloader import TileDownloader
+from tile_index import TileIndex
+from citygml_reader import iter_gml_buildings, surface_tags_from_parsing_d
+from surface_codec import encode_surfaces, decode_surfaces
+from triangulation_engine import triangulate_polygons, ear_clipping_triangles
+from stl_writer import BinaryStlWriter, DEFAULT_CHUNK_SIZE, triangle_chunks, triangle_records, write_stl
+from stl_reader import read_stl, closed_triangle_array, merge_stl_files
 
 PATH = os.getcwd()
 print(PATH)
 INPUT_FILES_FP = os.path.join(PATH, 'data')
 CATEGORY_DICT = os.path.join(INPUT_FILES_FP, 'category_d.json')
+# metres of geodata kept around the KML layers when tiles are cut to the project perimeter
+PERIMETER_MARGIN = 50
 
 
 def read_json_files(file_path):
@@ -50,12 +69,7 @@ def post_request(server_address, access_token, table_path, payload_json, printin
     or not.
     :return response.json(): The json dictionary of the created item.
     """
-    headers = {
-        'Authorization': 'Bearer %s' % access_token,
-        'Content-Type': 'application/json'
-    }
-    response = request("POST", os.path.join(server_address, table_path).replace('\\', "/"), headers=headers,
-                       data=payload_json)
+    response = get_client(server_address).post(table_path, access_token=access_token, data=payload_json)
     if printing:
         if response.status_code == 201:
             print("Response status code:",
@@ -86,12 +100,7 @@ def patch_request(server_address, access_token, table_path, item_id, payload_jso
     or not.
     :return response.json(): The json dictionary of the modified item.
     """
-    headers = {
-        'Authorization': 'Bearer %s' % access_token,
-        'Content-Type': 'application/json'
-    }
-    response = request("PATCH", os.path.join(server_address, table_path, str(item_id)).replace("\\", '/'),
-                       headers=headers, data=payload_json)
+    response = get_client(server_address).patch(table_path, item_id, access_token=access_token, data=payload_json)
     if printing:
         print(response.text.encode('utf8'))
     return response.json()
@@ -114,10 +123,7 @@ def obtain_token(token_credentials, server_address):
         "username": token_credentials['username'],
         "password": token_credentials['password']
     }
-    response = request("POST", os.path.join(server_address, 'oauth').replace("\\", "/"),
-                       headers={
-                           "Content-Type": "application/x-www-form-urlencoded"},
-                       data=payload)
+    response = get_client(server_address).request("POST", 'oauth', data=payload)
     response_dict = response.json()
     try:
         if response_dict['title']:
@@ -141,26 +147,166 @@ def get_request(server_address, access_token, table_path, printing=False, **kwar
     arguments. The additional query parameters are used e.g. customerId, projectId, clusterId, limit etc.
     :return response_json: The JSON dictionary that contains the response for the GET request.
     """
-    payload = {}
-    headers = {'Authorization': 'Bearer %s' % access_token}
-    url_basic = os.path.join(server_address, table_path).replace("\\", "/")
-    url_final = os.path.join(server_address, table_path).replace("\\", "/")
-
-    for kw_key, kw_value in kwargs.items():
-        if url_final == url_basic:
-            url_final = os.path.join(
-                url_basic + "?{}=".format(kw_key) + str(kw_value)).replace("\\", "/")
-        else:
-            url_final = os.path.join(
-                url_final + "&{}=".format(kw_key) + str(kw_value)).replace("\\", "/")
-    response = request("GET", url_final, headers=headers, data=payload)
+    response = get_client(server_address).get(table_path, access_token=access_token, params=kwargs)
     if printing:
-        print('url final', url_final)
+        print('url final', response.url)
         print(response.text.encode('utf8'))
     response_json = response.json()
     return response_json
 
 
+class PagingError(Exception):
+    pass
+
+
+def iter_get_request(server_address, access_token, table_path, page_size=500, prefetch=2, **kwargs):
+    """
+    Generator version of get_request for list endpoints. The items are read page by page with limit and offset and
+    yielded one at a time, so a consumer never holds more than a few pages in memory. The next pages are fetched in a
+    background thread while the current one is processed.
+
+    When the server reports maxItems, pages are read until maxItems items were read, so a server that caps the limit
+    below page_size is still read to the end; otherwise reading stops at the first page that is not page_size long.
+    If the server answers with a page it already sent (i.e. it ignores the offset), the rest is read with one request
+    for all maxItems items, like get_request does. A page answered with an error status raises requests.HTTPError in
+    the consumer, and a list that cannot be read completely raises PagingError, instead of ending the list early.
+    :param server_address: hostname of the environment.
+    :param access_token: contains the security credentials for a login session.
+    :param table_path: The specific sub-location of a given table on the server.
+    :param page_size: Number of items requested per page.
+    :param prefetch: Number of pages fetched ahead of the consumer.
+    :param kwargs: Additional query parameters e.g. projectId, target.
+    :return: Generator of the items of the 'list' of the responses.
+    """
+    pages = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def put(page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(offset, limit):
+        response = get_client(server_address).get(table_path, access_token=access_token,
+                                                  params=dict(kwargs, limit=limit, offset=offset))
+        if not response.ok:
+            print(table_path, 'page at offset', offset, 'failed:', response.status_code, response.text[:500])
+            response.raise_for_status()
+        response_json = response.json()
+        return response_json['list'], response_json.get('maxItems')
+
+    def fetch_pages():
+        offset = 0
+        seen_pages = set()
+        try:
+            while not stop.is_set():
+                page, max_items = fetch(offset, page_size)
+                page_key = (len(page), dumps(page[0], sort_keys=True) if page else None)
+                if page and page_key in seen_pages:
+                    if max_items is None:
+                        raise PagingError('%s returned the same page twice at offset %s and reports no maxItems.'
+                                          % (table_path, offset))
+                    print(table_path, 'ignores the offset, reading all', max_items, 'items with one request.')
+                    items, max_items = fetch(0, max_items)
+                    if max_items is not None and len(items) < max_items:
+                        raise PagingError('%s returned %s of %s items.' % (table_path, len(items), max_items))
+                    put(items[offset:])
+                    break
+                seen_pages.add(page_key)
+                if not page and max_items is not None and offset < max_items:
+                    raise PagingError('%s returned no items at offset %s of %s.' % (table_path, offset, max_items))
+                if not put(page):
+                    return
+                offset += len(page)
+                if max_items is not None:
+                    if offset >= max_items:
+                        break
+                elif len(page) != page_size:
+                    break
+            put(None)
+        except Exception as error:
+            put(error)
+
+    fetcher = threading.Thread(target=fetch_pages, daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            for item in page:
+                yield item
+    finally:
+        stop.set()
+
+
+# (server address, access token hash, table path, query parameters) -> (table generation, ETag, items), in the order
+# of their last use
+_LIST_CACHE = OrderedDict()
+_LIST_CACHE_SIZE = 32
+_LIST_CACHE_LOCK = threading.Lock()
+
+
+def get_cached_list(server_address, access_token, table_path, **kwargs):
+    """
+    Cached version of iter_get_request for the project tables (surroundings/buildings, surroundings/terrain) that are
+    read several times in one pipeline run. The items are kept per server, user, table and query parameters (e.g.
+    projectId, target), and only the _LIST_CACHE_SIZE most recently used lists are kept.
+
+    A cached list is only used after the server confirmed it: one item is requested for maxItems, then the whole list
+    is requested (limit=maxItems) with the ETag of the cached list in If-None-Match, and only a 304 answer returns the
+    cached items. The ETag covers the whole list, so edits from other clients are seen; a successful POST, PATCH or
+    DELETE sent to the table through the API client invalidates the list without asking the server. Lists of servers
+    that send no ETag or no maxItems are not cached.
+    The returned list is shared with the cache and must not be modified.
+    :param server_address: hostname of the environment.
+    :param access_token: contains the security credentials for a login session.
+    :param table_path: The specific sub-location of a given table on the server.
+    :param kwargs: Additional query parameters e.g. projectId, target.
+    :return items: List of the items of the table.
+    """
+    client = get_client(server_address)
+    token_hash = hashlib.sha256(str(access_token).encode('utf8')).hexdigest()
+    cache_key = (client.base_url, token_hash, table_path,
+                 tuple(sorted((key, str(value)) for key, value in kwargs.items())))
+    generation = client.table_generation(table_path)
+    probe = client.get(table_path, access_token=access_token, params=dict(kwargs, limit=1))
+    probe.raise_for_status()
+    max_items = probe.json().get('maxItems')
+    if max_items is None:
+        return list(iter_get_request(server_address, access_token, table_path, **kwargs))
+
+    with _LIST_CACHE_LOCK:
+        cached = _LIST_CACHE.get(cache_key)
+        if cached is not None:
+            _LIST_CACHE.move_to_end(cache_key)
+    headers = {'If-None-Match': cached[1]} if cached is not None and cached[0] == generation else None
+    response = client.get(table_path, access_token=access_token, params=dict(kwargs, limit=max_items, offset=0),
+                          headers=headers)
+    if response.status_code == 304 and headers is not None:
+        return cached[2]
+    response.raise_for_status()
+    items = response.json()['list']
+    etag = response.headers.get('ETag')
+    if len(items) < max_items:
+        # the server caps the limit, the list is read page by page and cannot be validated as a whole
+        return list(iter_get_request(server_address, access_token, table_path, **kwargs))
+    if etag is None:
+        return items
+    with _LIST_CACHE_LOCK:
+        _LIST_CACHE[cache_key] = (generation, etag, items)
+        _LIST_CACHE.move_to_end(cache_key)
+        while len(_LIST_CACHE) > _LIST_CACHE_SIZE:
+            _LIST_CACHE.popitem(last=False)
+    return items
+
+
 def setup_project(project_name):
     folder_name = project_name.replace(" ", "_")
     source_path = os.path.join(os.getcwd(), 'data', '00_StandardFolder')
@@ -186,8 +332,7 @@ def setup_project(project_name):
 
 
 def project_setup(config_file, customer_id, server_address, access_token):
-    get_existing_projects = get_request(
-        server_address, access_token, 'projects', limit=10000)['list']
+    get_existing_projects = iter_get_request(server_address, access_token, 'projects')
     existing_projects_d = {project['name']: project['id']
                            for project in get_existing_projects}
     if config_file['ProjectName'] in existing_projects_d:
@@ -218,8 +363,7 @@ def project_setup(config_file, customer_id, server_address, access_token):
 
 def customer_setup(customer_name, customer_language, server_address, access_token):
     print('server address', server_address)
-    get_existing_customers = get_request(
-        server_address, access_token, "customer", limit=10000)['list']
+    get_existing_customers = iter_get_request(server_address, access_token, "customer")
     existing_customer_d = {customer['name']: customer['id']
                            for customer in get_existing_customers}
     if customer_name in existing_customer_d:
@@ -312,16 +456,13 @@ def manual_stl_download(destination_path, reference_point, model_tree, object_d_
         if tree_name + '_remodeled.stl' not in os.listdir(os.path.join(stl_folder, 'remodeled_trees')):
             selected_tree_model_placement(reference_point, destination_path, tree_name,
                                           object_d_veg, model_tree)
-    tree_mesh_list = []
+    # the tree files are merged record by record, the triangles are not decoded
+    tree_stl_paths = []
     for stl_file in os.listdir(os.path.join(stl_folder, 'remodeled_trees')):
         if 'tree' in stl_file:
-            tree_mesh = mesh.Mesh.from_file(os.path.join(
-                stl_folder, 'remodeled_trees', stl_file))
-            tree_mesh_a = import_stl(tree_mesh)
-            tree_mesh_list.append(tree_mesh_a)
+            tree_stl_paths.append(os.path.join(stl_folder, 'remodeled_trees', stl_file))
 
-    all_trees = np.concatenate(tree_mesh_list)
-    export_stl(destination_path, all_trees, 'Vegetation')
+    merge_stl_files(tree_stl_paths, stl_file_path(destination_path, 'Vegetation'))
 
 
 # add CAD model check
@@ -383,8 +524,9 @@ def check_kml_setup(folder_name):
 
 def get_geodata_checklist(folder_name):
     folders = ['DSM', 'DTM', 'GML']
-    checklist = [0 if len(os.listdir(os.path.join(folder_name, 'GeospatialData', folder))) == 0 else 1 for folder in
-                 folders]
+    # point cloud tiles are decoded straight into the tile store and have no file in the layer folder
+    checklist = [0 if len(os.listdir(os.path.join(folder_name, 'GeospatialData', folder))) == 0 and
+                 not layer_tile_names(tile_store_folder(folder_name, folder)) else 1 for folder in folders]
     return all(checklist) == 1
 
 
@@ -444,12 +586,9 @@ def select_geo_template(folder_name):
 
 
 def get_object_d_vegetation(project_file_path):
-    kml_folder = os.path.join(project_file_path, 'GeospatialData', 'KML')
-    kml_file_name = os.listdir(kml_folder)[0]
-
-    kml_fp = os.path.join(kml_folder, kml_file_name)
+    kml_fp = get_kml_file_path(project_file_path)
     category_d = read_json_files(CATEGORY_DICT)
-    json_dict = polygon_from_kml(kml_fp, category_d)
+    json_dict = cached_polygon_from_kml(kml_fp, category_d)
 
     object_d_vegetation = {}
     for i in json_dict['objects']:
@@ -460,93 +599,6 @@ def get_object_d_vegetation(project_file_path):
     return object_d_vegetation
 
 
-def centroid_function(array):
-    """
-    Given a coordinate array [[x1, y1],...,[xn, yn]], this function finds the centroid point of the x and y coordinates.
-    :param array: The array we want to its center point.
-    :return round(sum_x / length, 2), round(sum_y / length, 2): The centroid point of the coordinate array.
-    """
-    length = array.shape[0]
-    try:
-        sum_x = np.sum(array[:, 0])
-        sum_y = np.sum(array[:, 1])
-        center_x = round(sum_x / length, 2)
-        center_y = round(sum_y / length, 2)
-        return center_x, center_y
-    except ZeroDivisionError:
-        print('empty array provided.')
-
-
-def polygon_from_kml(kml_file_path, category_d):
-    """
-    This function parses through a given KML file and creates polygons containing relevant data points. Additionally,
-    it converts the given lat long data into UTM coordinates.
-    :param kml_file_path: Folder where the KML file for the project is stored.
-    :param category_d: Dictionary containing data necessary for parsing the KML files.
-    :return object_d: A list of polygons in a dictionary for a given category.
-    """
-    object_d = {"objects": []}
-    kml_data = open(kml_file_path, "r")
-    polygon_found = False
-    layer_found = False
-    single_object_start = False
-    object_type = 'meh'
-    shape_a = None
-    name = None
-    centroid = None
-
-    for line in kml_data:
-        line = line.strip("\n")
-        line = line.strip("\t")
-        line = line.strip(" ")
-
-        if category_d['singleObject_end'] in line:
-            single_object_start = False
-
-        if single_object_start:
-            if category_d['ID_start'] in line:
-                line_6 = line[6:].split("<")
-                name = line_6[0]
-                # print(name)
-
-        if category_d['singleObject_start'] in line:
-            single_object_start = True
-
-        if category_d['category_end'] in line:
-            layer_found = False
-
-        if layer_found and single_object_start is False:
-            if category_d['ID_start'] in line:
-                line_b = line.split(">")
-                line_c = line_b[1].split("</")
-                object_type = line_c[0]
-                # print(type)
-        if category_d['category_start'] in line:
-            layer_found = True
-            # print(line)
-
-        if category_d["polygon_end"] in line:
-            polygon_found = False
-            polygon_d = {"shape": shape_a, "TYPE": object_type,
-                         "ID": name, "centroid": centroid}
-            object_d["objects"].append(polygon_d)
-        if polygon_found:
-            line_a = line.split(",")
-            line_a = line_a[:-1]
-            string_array = np.array(line_a)
-            float_array = string_array.astype(np.float)
-            utm_a = utm.from_latlon(float_array[1], float_array[0])
-            shape_a.append([round(utm_a[0], 2), round(utm_a[1], 2)])
-            points_array = np.array(shape_a)
-            centroid = centroid_function(points_array)
-
-        if category_d["polygon_start"] in line:
-            polygon_found = True
-            shape_a = []
-
-    return object_d
-
-
 def get_relevant_data(kml_file_path, category_d):
     """
     This function takes a previously constructed json dictionary (in the polygon_from_KML function) that contains data
@@ -560,7 +612,7 @@ def get_relevant_data(kml_file_path, category_d):
     the points from the buildings, vegetation and topography, the vegetation object dictionary and the target building
     shape.
     """
-    json_dict = polygon_from_kml(kml_file_path, category_d)
+    json_dict = cached_polygon_from_kml(kml_file_path, category_d)
 
     target_building_center = []
     target_area_center = []
@@ -594,116 +646,178 @@ def get_relevant_data(kml_file_path, category_d):
 
 
 # need to change to download data for everything - right now, just trees
-def nrw_download(unique_list_layers, geo_spatial_list, data_type):
+def layer_tile_names(folder):
+    """
+    :return: Set of the file names without extension in a layer folder, read with a single listdir.
+    """
+    if not os.path.isdir(folder):
+        return set()
+    return {file_name.split('.')[0] for file_name in os.listdir(folder)}
+
+
+def existing_tile_names(project_folder, data_type, layer_folder, perimeter):
+    """
+    :return: Set of the tiles of a layer that do not have to be downloaded again: the tiles in the layer folder, and
+             the tiles in the tile store that hold all of their points inside the perimeter. A tile that was cut to a
+             smaller or a different perimeter in an earlier run is downloaded and ingested again.
+    """
+    store_folder = tile_store_folder(project_folder, data_type)
+    return layer_tile_names(layer_folder) | \
+        {tile_name for tile_name in layer_tile_names(store_folder)
+         if tile_covers(tile_store_path(project_folder, data_type, tile_name), perimeter)}
+
+
+def nrw_tile_processor(data_type, layer_folder, tile_name, extension, downloader, ingest_pool):
+    """
+    Builds the function that puts a downloaded NRW tile into its layer folder; it runs in the download worker. DSM
+    point clouds are handed to the ingest pool and decoded straight into the tile store, the other tiles are linked
+    from the tile cache.
+    """
+    def process(file_path):
+        file_name = os.path.join(layer_folder, tile_name + extension)
+        print(data_type, file_name)
+        if data_type == 'DSM':
+            ingest_pool.submit(file_path, data_type, tile_name, remove_source=False)
+        else:
+            downloader.tile_cache.materialise(file_path, file_name)
+    return process
+
+
+def gzip_tile_consumer(store_fp, perimeter):
+    """
+    Builds the function that decompresses a gzipped text tile from the download stream into the tile store, keeping
+    only the points in the perimeter; it runs in the download worker.
+    """
+    def consume(stream):
+        with gzip.GzipFile(fileobj=stream, mode='rb') as f_in:
+            ingest_points(read_xyz_stream(f_in, perimeter), store_fp, store_fp, clip=perimeter)
+    return consume
+
+
+def nrw_download(unique_list_layers, geo_spatial_list, data_type, downloader, ingest_pool, perimeter=None):
+    """
+    Queues the NRW tiles of a layer on the downloader. Tiles already in the layer folder, or in the tile store with
+    all of their points inside the perimeter, are skipped. Gzipped DTM tiles are decompressed into the tile store
+    while they are downloaded.
+    :param geo_spatial_list: [url base, url appendix, layer folder].
+    :param downloader: TileDownloader the tiles are downloaded with.
+    :param ingest_pool: TileIngestPool the point cloud tiles are decoded with.
+    :param perimeter: Optional [min_x, min_y, max_x, max_y] the streamed tiles are cut to.
+    """
+    if data_type not in unique_list_layers:
+        return
     data_list = unique_list_layers[data_type]
+    existing_tiles = existing_tile_names(downloader.project_folder, data_type, geo_spatial_list[2], perimeter)
     for x in data_list[0]:
         for y in data_list[1]:
             zip_file_addon = str(x) + "_" + str(y)
+            if zip_file_addon in existing_tiles:
+                continue
             download_url = geo_spatial_list[0] + \
                 zip_file_addon + geo_spatial_list[1]
-            url_string_split = download_url.split('/')[-1].split('.')[0]
-            files_list = [file_name.split(
-                '.')[0] for file_name in os.listdir(geo_spatial_list[2])]
             extension = '.' + download_url.rsplit('.', 1)[1]
-            if url_string_split not in files_list:
-                r = requests.get(download_url)
-                print('url:', download_url, 'status code:', r.status_code)
-                if r.status_code == 200:
-                    file_name = os.path.join(
-                        geo_spatial_list[2], zip_file_addon + extension)
-                    print(data_type, file_name)
-                    with open(file_name, 'wb') as f:
-                        f.write(r.content)
-                    if data_type == 'DSM' and zip_file_addon + extension in os.listdir(geo_spatial_list[2]):
-                        cmdline = r'laszip.exe -i "{}" -otxt -oparse xyz'.format(
-                            os.path.join(PATH, file_name).replace("//", "\\"))
-                        print(cmdline)
-                        call("start cmd /K " + cmdline,
-                             cwd=INPUT_FILES_FP, shell=True)
-                        print('waiting for the .laz file to be converted to .txt')
-                        time.sleep(300)
-                        os.remove(os.path.join(PATH, file_name))
-                    elif data_type == 'DTM' and extension == '.gz' and \
-                            zip_file_addon + extension in os.listdir(geo_spatial_list[2]):
-                        with gzip.open(os.path.join(geo_spatial_list[2], zip_file_addon + extension),
-                                       'rb') as f_in:
-                            with open(os.path.join(geo_spatial_list[2], zip_file_addon + '.txt'),
-                                      'wb') as f_out:
-                                shutil.copyfileobj(f_in, f_out)
-                        os.remove(os.path.join(PATH, file_name))
-                    elif data_type == 'GML':
-                        filename = os.path.join(
-                            geo_spatial_list[2], zip_file_addon + extension)
-                        print('filename', filename)
-                        with open(filename, 'wb') as f:
-                            f.write(r.content)
-
-
-def berlin_download(unique_list_layers, geo_spatial_list, data_type):
+            if data_type == 'DTM' and extension == '.gz':
+                store_fp = tile_store_path(downloader.project_folder, data_type, zip_file_addon)
+                downloader.submit_stream(download_url, data_type, download_url.split('/')[-1],
+                                         gzip_tile_consumer(store_fp, perimeter))
+            else:
+                downloader.submit(download_url, data_type, download_url.split('/')[-1],
+                                  nrw_tile_processor(data_type, geo_spatial_list[2], zip_file_addon, extension,
+                                                     downloader, ingest_pool))
+
+
+def berlin_tile_processor(data_type, layer_folder, store_fp, perimeter):
+    """
+    Builds the function that unpacks a Berlin zip from the tile cache; it runs in the download worker. The point
+    members of DSM and DTM zips are read straight from the archive into one tile of the tile store, cut to the
+    perimeter; GML members are written to the layer folder.
+    """
+    def process(file_path):
+        with zipfile.ZipFile(file_path, 'r') as zip_ref:
+            members = [member for member in zip_ref.infolist() if not member.is_dir()]
+            if data_type == 'GML':
+                for member in members:
+                    zip_ref.extract(member, layer_folder)
+                return
+            points = [np.zeros((0, 3))]
+            for member in members:
+                if member.filename.lower().endswith(('.xyz', '.txt')):
+                    with zip_ref.open(member) as f_in:
+                        points.append(read_xyz_stream(f_in, perimeter))
+            ingest_points(np.concatenate(points), store_fp, file_path, clip=perimeter)
+    return process
+
+
+def berlin_download(unique_list_layers, geo_spatial_list, data_type, downloader, perimeter=None):
+    """
+    Queues the Berlin tiles of a layer on the downloader. Tiles already in the layer folder, or in the tile store
+    with all of their points inside the perimeter, are skipped.
+    :param geo_spatial_list: [url base, layer folder].
+    :param downloader: TileDownloader the tiles are downloaded with.
+    :param perimeter: Optional [min_x, min_y, max_x, max_y] the DSM and DTM tiles are cut to.
+    """
+    if data_type not in unique_list_layers:
+        return
     appendix = '.zip'
     data_list = unique_list_layers[data_type]
+    existing_tiles = existing_tile_names(downloader.project_folder, data_type, geo_spatial_list[1], perimeter)
     for x in data_list[0]:
         for y in data_list[1]:
             zip_file_addon = str(x) + "_" + str(y)
-            name = zip_file_addon
+            if zip_file_addon in existing_tiles:
+                continue
             download_url = geo_spatial_list[0] + zip_file_addon + appendix
-            url_string_split = download_url.split('/')[-1].split('.')[0]
-            files_list = [file_name.split(
-                '.')[0] for file_name in os.listdir(geo_spatial_list[1])]
-            if url_string_split not in files_list:
-                r = requests.get(download_url)
-                print('url:', download_url, 'status code:', r.status_code)
-                filename = os.path.join(geo_spatial_list[1], name + '.zip')
-
-                if r.status_code == 200:
-                    with open(filename, 'wb') as f:
-                        f.write(r.content)
-                    with zipfile.ZipFile(filename, 'r') as zip_ref:
-                        zip_ref.extractall(geo_spatial_list[1])
-                    os.remove(filename)
-
-
-def hamburg_download(unique_list_layers, geo_spatial_base_fp, geo_spatial_project_fp):
-    for layer in unique_list_layers:
-        for key in layer:
-            print(key)
-            for x in layer[key][0]:
-                for y in layer[key][1]:
-                    zip_file_addon = str(x) + "_" + str(y)
-                    for i in os.listdir(geo_spatial_base_fp):
-                        if key == 'GML':
-                            if i[5:13] == zip_file_addon:
-                                print(zip_file_addon)
-                                shutil.copy2(os.path.join(
-                                    geo_spatial_base_fp, i), geo_spatial_project_fp)
-                        else:
-                            if i[7:15] == zip_file_addon:
-                                print(zip_file_addon)
-                                shutil.copy2(os.path.join(
-                                    geo_spatial_base_fp, i), geo_spatial_project_fp)
-
-
-def geo_data_download(project_folder, county, unique_list_layers):
+            store_fp = tile_store_path(downloader.project_folder, data_type, zip_file_addon)
+            downloader.submit(download_url, data_type, zip_file_addon + appendix,
+                              berlin_tile_processor(data_type, geo_spatial_list[1], store_fp, perimeter))
+
+
+def hamburg_download(unique_list_layers, geo_spatial_base_fp, geo_spatial_project_fp, data_type, tile_cache):
+    """
+    Copies the Hamburg tiles of a layer from the shared drive into the project, through the tile cache. The files of
+    a tile are looked up in the tile index of the shared drive folder instead of listing the folder for every tile.
+    :param geo_spatial_base_fp: Folder of the layer on the shared drive.
+    :param geo_spatial_project_fp: Layer folder of the project.
+    :param data_type: The type of data (GML, DSM or DTM).
+    :param tile_cache: TileCache the tiles are stored in.
+    """
+    if data_type not in unique_list_layers:
+        return
+    print(data_type)
+    tile_index = TileIndex(geo_spatial_base_fp)
+    data_list = unique_list_layers[data_type]
+    for x in data_list[0]:
+        for y in data_list[1]:
+            zip_file_addon = str(x) + "_" + str(y)
+            for file_name in tile_index.lookup(data_type, zip_file_addon):
+                print(zip_file_addon)
+                cached_fp = tile_cache.put_file(os.path.join(geo_spatial_base_fp, file_name), 'Hamburg', data_type)
+                tile_cache.materialise(cached_fp, os.path.join(geo_spatial_project_fp, file_name))
+
+
+def geo_data_download(project_folder, county, unique_list_layers, download_workers=4, perimeter=None):
     gml_folder = os.path.join(project_folder, 'GeospatialData', 'GML')
     dtm_folder = os.path.join(project_folder, 'GeospatialData', 'DTM')
     dsm_folder = os.path.join(project_folder, 'GeospatialData', 'DSM')
     print('UNIQUE LIST LAYERS', unique_list_layers)
+    downloader = TileDownloader(project_folder, county, workers=download_workers)
+    ingest_pool = TileIngestPool(project_folder)
     if county == 'NRW':
         url_base = r"https://www.opengeodata.nrw.de/produkte/geobasis/"
         gml_url_base = os.path.join(url_base, "3dg/lod2_gml/lod2_gml/LoD2_32_")
         gml_appendix = "_1_NW.gml"
         gml_list = [gml_url_base, gml_appendix, gml_folder]
-        nrw_download(unique_list_layers, gml_list, 'GML')
+        nrw_download(unique_list_layers, gml_list, 'GML', downloader, ingest_pool, perimeter)
 
         dsm_url_base = os.path.join(url_base, "hm/3dm_l_las/3dm_l_las/3dm_32_")
         dsm_appendix = "_1_nw.laz"
         dsm_list = [dsm_url_base, dsm_appendix, dsm_folder]
-        nrw_download(unique_list_layers, dsm_list, 'DSM')
+        nrw_download(unique_list_layers, dsm_list, 'DSM', downloader, ingest_pool, perimeter)
 
         dtm_url_base = os.path.join(url_base, "hm/dgm1_xyz/dgm1_xyz/dgm1_32_")
         dtm_appendix = "_1_nw.xyz.gz"
         dtm_list = [dtm_url_base, dtm_appendix, dtm_folder]
-        nrw_download(unique_list_layers, dtm_list, 'DTM')
+        nrw_download(unique_list_layers, dtm_list, 'DTM', downloader, ingest_pool, perimeter)
 
     elif county == 'Berlin':
         url_base = "http://fbinter.stadt-berlin.de/fb/atom/"
@@ -715,9 +829,9 @@ def geo_data_download(project_folder, county, unique_list_layers):
         dsm_list = [dsm_url_base, dsm_folder]
         dtm_list = [dtm_url_base, dtm_folder]
 
-        berlin_download(unique_list_layers, gml_list, 'GML')
-        berlin_download(unique_list_layers, dsm_list, 'DSM')
-        berlin_download(unique_list_layers, dtm_list, 'DTM')
+        berlin_download(unique_list_layers, gml_list, 'GML', downloader, perimeter)
+        berlin_download(unique_list_layers, dsm_list, 'DSM', downloader, perimeter)
+        berlin_download(unique_list_layers, dtm_list, 'DTM', downloader, perimeter)
 
     elif county == 'Hamburg':
         gml_base = r"G:\Shared drives\CityGML-DataBase\Germany\Hamburg"
@@ -728,18 +842,20 @@ def geo_data_download(project_folder, county, unique_list_layers):
         dtm_folder = os.path.join(project_folder, 'GeospatialData', 'DTM')
         dsm_folder = os.path.join(project_folder, 'GeospatialData', 'DSM')
 
-        hamburg_download(unique_list_layers, gml_base, gml_folder)
-        hamburg_download(unique_list_layers, dsm_base, dsm_folder)
-        hamburg_download(unique_list_layers, dtm_base, dtm_folder)
+        hamburg_download(unique_list_layers, gml_base, gml_folder, 'GML', downloader.tile_cache)
+        hamburg_download(unique_list_layers, dsm_base, dsm_folder, 'DSM', downloader.tile_cache)
+        hamburg_download(unique_list_layers, dtm_base, dtm_folder, 'DTM', downloader.tile_cache)
 
+    downloader.close()
+    ingest_pool.close()
+    if os.path.isdir(dtm_folder) and os.listdir(dtm_folder):
+        ingest_layer(project_folder, 'DTM')
 
-def get_object_d_vegetation(project_file_path):
-    kml_folder = os.path.join(project_file_path, 'GeospatialData', 'KML')
-    kml_file_name = os.listdir(kml_folder)[0]
 
-    kml_fp = os.path.join(kml_folder, kml_file_name)
+def get_object_d_vegetation(project_file_path):
+    kml_fp = get_kml_file_path(project_file_path)
     category_d = read_json_files(CATEGORY_DICT)
-    json_dict = polygon_from_kml(kml_fp, category_d)
+    json_dict = cached_polygon_from_kml(kml_fp, category_d)
 
     object_d_vegetation = {}
     for i in json_dict['objects']:
@@ -766,6 +882,21 @@ def automatic_stl_download(folder_path, reference_point):
                                         object_d_veg)
 
 
+def geodata_perimeter(target_building_centroid, point_sets, margin=PERIMETER_MARGIN):
+    """
+    Bounding box of the geodata a project needs: the square around the target building centroid that holds every
+    point of the KML layers, and with it the circular terrain perimeter, widened by margin.
+    :param target_building_centroid: The UTM coordinates of the target building's centroid
+    :param point_sets: Points of the KML layers (e.g. points_buildings, points_vegetation, points_topography).
+    :param margin: Distance in metres added on every side.
+    :return perimeter: [min_x, min_y, max_x, max_y]
+    """
+    radius = max(distance_max_from_class(points, target_building_centroid[:2]) for points in point_sets if points)
+    radius += margin
+    return [target_building_centroid[0] - radius, target_building_centroid[1] - radius,
+            target_building_centroid[0] + radius, target_building_centroid[1] + radius]
+
+
 def get_unique_layers(county, points_buildings=None, points_vegetation=None, points_topography=None):
     unique_d_layers = {}
     if points_buildings:
@@ -812,8 +943,176 @@ def distance_max_from_class(points_shape, target_building_centroid):
     return maximum_distance
 
 
+def terrain_points_in_perimeter(dtm_tiles, target_building_centroid, max_distance_terrain, chunk_size=1000000):
+    """
+    Selects the DTM points within max_distance_terrain of the target building centroid. The points are processed as
+    array chunks of the tile store columns: a bounding box test on the stored offsets rejects everything outside the
+    perimeter square before any point is materialised, then the remaining points get their height quantized to 2 m,
+    are converted to int and are tested against the circular perimeter.
+    :param dtm_tiles: The PointTile objects of the DTM layer.
+    :param target_building_centroid: The UTM coordinates of the target building's centroid
+    :param max_distance_terrain: Radius of the perimeter of concern.
+    :param chunk_size: Number of points processed at once.
+    :return point_cloud_array: (n, 3) int array of the points in the perimeter, in tile order.
+    """
+    center_x, center_y = float(target_building_centroid[0]), float(target_building_centroid[1])
+    # the int conversion can move a point by up to 1 m, so the square is widened by 1 m
+    min_x, max_x = center_x - max_distance_terrain - 1, center_x + max_distance_terrain + 1
+    min_y, max_y = center_y - max_distance_terrain - 1, center_y + max_distance_terrain + 1
+
+    selected_chunks = []
+    selected_count = 0
+    for dtm_tile in dtm_tiles:
+        print("Currently processing:", dtm_tile.store_fp)
+        if dtm_tile.bbox_intersects(min_x, min_y, max_x, max_y):
+            origin_x, origin_y = dtm_tile.origin
+            for start in range(0, len(dtm_tile), chunk_size):
+                x_offset = dtm_tile.x_offset[start:start + chunk_size]
+                y_offset = dtm_tile.y_offset[start:start + chunk_size]
+                in_square = (x_offset >= min_x - origin_x) & (x_offset <= max_x - origin_x) & \
+                    (y_offset >= min_y - origin_y) & (y_offset <= max_y - origin_y)
+                rows = np.nonzero(in_square)[0]
+                if len(rows) == 0:
+                    continue
+
+                x = np.trunc(x_offset[rows] + origin_x)
+                y = np.trunc(y_offset[rows] + origin_y)
+                z = np.trunc(np.round(dtm_tile.z[start:start + chunk_size][rows].astype(np.float64) / 2) * 2)
+                distance = np.sqrt((center_x - x) ** 2 + (center_y - y) ** 2)
+                in_perimeter = distance <= max_distance_terrain
+                chunk = np.column_stack((x[in_perimeter], y[in_perimeter], z[in_perimeter])).astype(np.int64)
+                selected_chunks.append(chunk)
+                selected_count += len(chunk)
+        print(str(selected_count), " belong in the perimeter of concern.")
+
+    if not selected_chunks:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.concatenate(selected_chunks)
+
+
+def group_points_by_height(point_cloud_array):
+    """
+    Groups the terrain points by their (quantized) height. The heights keep the order in which they first appear in
+    the point cloud and the points of a height keep their point cloud order.
+    :param point_cloud_array: (n, 3) int array of terrain points.
+    :return height_dictionary: Dictionary height -> (m, 3) array of the points at that height.
+    """
+    heights, first_position, inverse = np.unique(point_cloud_array[:, 2], return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    groups = np.split(point_cloud_array[order], np.cumsum(np.bincount(inverse, minlength=len(heights)))[:-1])
+
+    height_dictionary = dict()
+    for position in np.argsort(first_position, kind='stable'):
+        height_dictionary[int(heights[position])] = groups[position]
+    return height_dictionary
+
+
+def terrain_surfaces_from_alpha_shape(height, coordinates, alpha_shape_value):
+    """
+    Computes the alpha shape of the terrain points of one height and turns its outline(s) into terrain surfaces.
+    :param height: The quantized height of the points.
+    :param coordinates: (n, 3) array of the terrain points at that height.
+    :param alpha_shape_value: Alpha parameter of the alpha shape.
+    :return surfaces: List of terrain surface dictionaries of that height.
+    """
+    xy_coordinate_list = np.asarray(coordinates)[:, :2].tolist()
+    alpha_shape1 = alphashape.alphashape(xy_coordinate_list, alpha_shape_value)
+
+    if alpha_shape1.geom_type == 'MultiPolygon':
+        outlines = [np.array(i.exterior.coords) for i in alpha_shape1.geoms]
+    elif alpha_shape1.geom_type == 'Polygon':
+        outlines = [np.array(alpha_shape1.exterior.coords)]
+    else:
+        outlines = [np.array(alpha_shape1.coords)]
+
+    surfaces = []
+    for counter, polygon_array in enumerate(outlines, start=1):
+        polygon_list = polygon_array.tolist()
+        for k in polygon_list:
+            k.append(height)
+        polygon_list_int = [[int(float(j)) for j in i] for i in polygon_list]
+        result = {"polygon": polygon_list_int, "ID": str(height) + "_" + str(counter),
+                  "type": "Terrain"}
+        surfaces.append(result)
+    return surfaces
+
+
+def _terrain_surfaces_job(job):
+    height, coordinates, alpha_shape_value = job
+    return height, terrain_surfaces_from_alpha_shape(height, coordinates, alpha_shape_value)
+
+
+def compute_terrain_surfaces(height_dictionary, alpha_shape_value, workers=None):
+    """
+    Computes the terrain surfaces of every height band. The alpha shapes are the expensive part, so with more than one
+    worker they are computed in a process pool. The results are returned in the order of height_dictionary, so the
+    terrain objects are the same as with a serial run.
+    :param height_dictionary: Dictionary height -> (n, 3) array of the terrain points at that height.
+    :param alpha_shape_value: Alpha parameter of the alpha shapes.
+    :param workers: Number of worker processes. None uses one per CPU core, 1 computes everything in this process.
+    :return: List of (height, surfaces) tuples.
+    """
+    jobs = [(height, coordinates, alpha_shape_value) for height, coordinates in height_dictionary.items()]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return [_terrain_surfaces_job(job) for job in jobs]
+
+    # larger bands first keeps the pool busy, the results are put back into height order afterwards
+    order = sorted(range(len(jobs)), key=lambda position: len(jobs[position][1]), reverse=True)
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for position, result in zip(order, executor.map(_terrain_surfaces_job, [jobs[i] for i in order])):
+            results[position] = result
+    for height, surfaces in results:
+        print('alpha shape done for height', height, len(surfaces), 'surface(s)')
+    return results
+
+
+def post_terrain_objects_bulk(server_address, access_token, terrain_payloads, retries=3, backoff=1.0):
+    """
+    Uploads all terrain objects of a project over the pooled keep-alive session of the API client instead of opening a
+    new connection for every height band. Every object is its own POST, so an object is only sent again if its
+    request failed before it reached the server; after a timeout or a 5xx response the object may have been stored
+    already, and sending it again would create a second TR_ item.
+    :param server_address: hostname of the environment where we post the data.
+    :param access_token: contains the security credentials for a login session.
+    :param terrain_payloads: List of terrain payload dictionaries (projectId, data, name).
+    :param retries: Number of retries of an object whose request could not be sent.
+    :param backoff: Seconds to wait before the first retry, doubled for every further retry.
+    :return upload_report: Dictionary name -> {"uploaded": bool, "status_code": int or None, "error": str or None}.
+    """
+    upload_report = {}
+    client = get_client(server_address)
+    for payload in terrain_payloads:
+        name = payload['name']
+        payload_json = json.dumps(payload)
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                response = client.post("surroundings/terrain", access_token=access_token, data=payload_json)
+            except requests.exceptions.RequestException as error:
+                upload_report[name] = {"uploaded": False, "status_code": None, "error": str(error)}
+                if request_not_sent(error):
+                    continue
+                break
+            upload_report[name] = {"uploaded": response.status_code in (200, 201),
+                                   "status_code": response.status_code,
+                                   "error": response.text[:500] if response.status_code >= 400 else None}
+            break
+
+    failed_names = [name for name, report in upload_report.items() if not report["uploaded"]]
+    print(len(upload_report) - len(failed_names), 'of', len(upload_report), 'terrain objects uploaded.')
+    if failed_names:
+        print('terrain objects that could not be uploaded:', failed_names)
+    return upload_report
+
+
 def post_terrain_objects_cloud(server_address, access_token, project_folder, project_id, alpha_shape_value,
-                               target_building_centroid, points_topography):
+                               target_building_centroid, points_topography, alpha_shape_workers=None):
     """    project_id = 8363
         project_folder = r'G:\Shared drives\Julia\flask\projects\Intercontinental-Duesseldorf'
         server_address = r'https://leaftech-api.dev1.secu-ring.de/api/'
@@ -822,15 +1121,11 @@ def post_terrain_objects_cloud(server_address, access_token, project_folder, pro
                          "password": 'braynio'}
         access_token = obtain_token(credentials_d, server_address)"""
 
-    dtm_folder = os.path.join(project_folder, 'GeospatialData', 'DTM')
-    get_terrain_objects = get_request(
-        server_address, access_token, "surroundings/terrain", projectId=project_id)
+    get_terrain_objects = get_cached_list(server_address, access_token, "surroundings/terrain", projectId=project_id)
     terrain_objects_list = []
-    for terrain_object in get_terrain_objects['list']:
+    for terrain_object in get_terrain_objects:
         terrain_objects_list.append(terrain_object['name'])
 
-    get_tb = get_request(server_address, access_token,
-                         "surroundings/buildings", projectId=project_id, target='true')
     """    points_topography = [[343894.81, 5676862.05],
                              [343505.34, 5676679.48],
                              [344231.26, 5675990.26],
@@ -849,137 +1144,43 @@ def post_terrain_objects_cloud(server_address, access_token, project_folder, pro
     max_distance_terrain = distance_max_from_class(
         points_topography, target_building_centroid[:2])
 
-    coordinate_list_int = []
-    for file in os.listdir(dtm_folder):
-        print("Currently processing:", os.path.join(dtm_folder, file))
-        dtm_file = open(os.path.join(dtm_folder, file), encoding='utf8')
-        for i in dtm_file:
-            unique_coordinate = list(map(float, i.split()))
-            if len(str(int(unique_coordinate[0]))) == 8:
-                unique_coordinate[0] = float(str(unique_coordinate[0])[2:])
-            unique_coordinate[2] = round(unique_coordinate[2] / 2) * 2
-            unique_coordinate = list(map(int, unique_coordinate))
-            distance = np.linalg.norm(
-                np.array(target_building_centroid) - np.array(unique_coordinate[:2]))
-            if distance <= max_distance_terrain:
-                coordinate_list_int.append(unique_coordinate)
-        print(str(len(coordinate_list_int)),
-              " belong in the perimeter of concern.")
-    point_cloud_array = np.array(coordinate_list_int)
-
-    height_dictionary = dict()
-
-    for unique_coordinates in coordinate_list_int:
-        # print(unique_coordinates)
-        if unique_coordinates[2] in height_dictionary:
-            # append the new number to the existing array at this slot
-            height_dictionary[unique_coordinates[2]].append(unique_coordinates)
-        else:
-            # create a new array in this slot
-            height_dictionary[unique_coordinates[2]] = [unique_coordinates]
-    height_dictionary.keys()
+    point_cloud_array = terrain_points_in_perimeter(open_layer(project_folder, 'DTM'), target_building_centroid[:2],
+                                                    max_distance_terrain)
+    height_dictionary = group_points_by_height(point_cloud_array)
     print(height_dictionary.keys())
 
+    pending_heights = {}
     for height, coordinates in height_dictionary.items():
         print(height, len(coordinates))
         if 'TR_' + str(height) not in terrain_objects_list:
             if height > 0:
-
-                height_array = np.array(coordinates)
-                print('1')
-                xy_coordinate_array = height_array[:, :2]
-                print('2')
-                xy_coordinate_list = xy_coordinate_array.tolist()
-                print('3')
-                alpha_shape1 = alphashape.alphashape(
-                    xy_coordinate_list, alpha_shape_value)
-                print('4')
-                terrain_dict = {"ID": "TR_" + str(height), "surfaces": []}
-
-                counter = 1
-                if alpha_shape1.type == 'MultiPolygon':
-                    print('5', alpha_shape1.type)
-                    for i in alpha_shape1:
-                        polygon_array = np.array(i.exterior)
-                        print('6')
-                        polygon_list = polygon_array.tolist()
-                        for k in polygon_list:
-                            k.append(height)
-                        polygon_list_int = [[int(float(j))
-                                             for j in i] for i in polygon_list]
-                        result = {"polygon": polygon_list_int, "ID": str(height) + "_" + str(counter),
-                                  "type": "Terrain"}
-                        print(str(height) + "_" + str(counter))
-                        terrain_dict['surfaces'].append(result)
-                        counter += 1
-
-                    payload_terrain = {
-                        "projectId": project_id,
-                        "data": str(terrain_dict['surfaces']),
-                        "name": terrain_dict['ID']
-                    }
-                    payload_terrain_json = json.dumps(payload_terrain)
-                    post_request(server_address, access_token,
-                                 "surroundings/terrain", payload_terrain_json)
-
-                elif alpha_shape1.type == 'Polygon':
-                    print(alpha_shape1.type)
-                    polygon_array = np.array(alpha_shape1.exterior)
-                    polygon_list = polygon_array.tolist()
-                    for k in polygon_list:
-                        k.append(height)
-                    polygon_list_int = [[int(float(j))
-                                         for j in i] for i in polygon_list]
-                    result = {"polygon": polygon_list_int, "ID": str(height) + "_" + str(counter),
-                              "type": "Terrain"}
-                    print(str(height) + "_" + str(counter))
-                    terrain_dict['surfaces'].append(result)
-                    counter += 1
-
-                    payload_terrain = {
-                        "projectId": project_id,
-                        "data": str(terrain_dict['surfaces']),
-                        "name": terrain_dict['ID']
-                    }
-                    payload_terrain_json = json.dumps(payload_terrain)
-                    post_request(server_address, access_token,
-                                 "surroundings/terrain", payload_terrain_json)
-
-                else:
-                    polygon_array = np.array(alpha_shape1.coords)
-                    polygon_list = polygon_array.tolist()
-                    for k in polygon_list:
-                        k.append(height)
-                    polygon_list_int = [[int(float(j))
-                                         for j in i] for i in polygon_list]
-                    result = {"polygon": polygon_list_int, "ID": str(height) + "_" + str(counter),
-                              "type": "Terrain"}
-                    print(str(height) + "_" + str(counter))
-                    terrain_dict['surfaces'].append(result)
-                    counter += 1
-
-                    payload_terrain = {
-                        "projectId": project_id,
-                        "data": str(terrain_dict['surfaces']),
-                        "name": terrain_dict['ID']
-                    }
-                    payload_terrain_json = json.dumps(payload_terrain)
-                    post_request(server_address, access_token,
-                                 "surroundings/terrain", payload_terrain_json)
+                pending_heights[height] = coordinates
+
+    terrain_surfaces = compute_terrain_surfaces(pending_heights, alpha_shape_value, alpha_shape_workers)
+    terrain_payloads = []
+    for height, surfaces in terrain_surfaces:
+        terrain_dict = {"ID": "TR_" + str(height), "surfaces": surfaces}
+        payload_terrain = {
+            "projectId": project_id,
+            "data": encode_surfaces(terrain_dict['surfaces']),
+            "name": terrain_dict['ID']
+        }
+        terrain_payloads.append(payload_terrain)
+    post_terrain_objects_bulk(server_address, access_token, terrain_payloads)
 
     return point_cloud_array
 
 
 def building_utm_center(server_address, access_token, project_id):
-    get_tb = get_request(server_address, access_token,
-                         "surroundings/buildings", projectId=project_id, target='true')
+    get_tb = get_cached_list(server_address, access_token, "surroundings/buildings", projectId=project_id,
+                             target='true')
 
     x_coordinates_list = []
     y_coordinates_list = []
     z_coordinates_list = []
 
-    for items in get_tb['list']:
-        building_dict = ast.literal_eval(items['data'])
+    for items in get_tb:
+        building_dict = decode_surfaces(items['data'])
         for circle_element in building_dict:
             if circle_element['surface_type'] == 'GROUND':
                 polygon = circle_element['polygon']
@@ -994,7 +1195,7 @@ def building_utm_center(server_address, access_token, project_id):
     return building_center
 
 
-def poisson_mesh_triangulation(point_cloud_array, depth, project_folder):
+def poisson_mesh_triangle_array(point_cloud_array, depth, project_folder, utm_center=None):
     """
     This function takes a given point cloud (the terrain layer) and returns an array of triangles composed from the
     points in the point cloud. The Poisson reconstruction method for triangulation is used from the Open3d library.
@@ -1026,13 +1227,15 @@ def poisson_mesh_triangulation(point_cloud_array, depth, project_folder):
     Exporting the data is straightforward with the write_triangle_mesh function. We just specify within the name of the
     created file, the extension that we want and the mesh to export.
 
-    Finally, we create the triangle list.
+    Finally, we create the triangle array by indexing the vertices with the triangles of the mesh.
     :param point_cloud_array: The point cloud array that we want to triangulate.
     :param depth: Maximum depth of the tree that will be used for surface reconstruction. Running at depth d corresponds
     to solving on a grid whose resolution is no larger than 2^d x 2^d x 2^d. Note that since the reconstructor adapts
     the octree to the sampling density, the specified reconstruction depth is only an upper bound.
     :param project_folder: Directory where the project is stored.
-    :return: Triangle array resulting from the mesh.
+    :param utm_center: If given, the vertices are normed to this point and rounded to mm before the triangles are
+    built, and the result is float32, ready for the STL buffer.
+    :return: (n, 3, 3) triangle array resulting from the mesh.
     """
     if "DigitalTwin" in project_folder:
         output_path = os.path.join(project_folder, "Visualization", "output")
@@ -1050,17 +1253,22 @@ def poisson_mesh_triangulation(point_cloud_array, depth, project_folder):
     poisson_mesh_crop = poisson_mesh.crop(bbox)
     o3d.io.write_triangle_mesh(os.path.join(output_path, ("poisson_mesh_terrain_depth_" + str(depth) + ".ply")),
                                poisson_mesh_crop)
-    vertices_array = np.asarray(poisson_mesh_crop.vertices).tolist()
-    triangles_index_position = np.asarray(poisson_mesh_crop.triangles).tolist()
+    vertices_array = np.asarray(poisson_mesh_crop.vertices)
+    triangles_index_position = np.asarray(poisson_mesh_crop.triangles)
+
+    if utm_center is not None:
+        # norming the vertices once is the same as norming every corner of every triangle
+        vertices_array = np.round(vertices_array - np.asarray(utm_center, dtype=np.float64), 3).astype(np.float32)
+    return vertices_array[triangles_index_position]
 
-    triangle_list = []
-    for i in triangles_index_position:
-        triangle_single = []
-        for j in i:
-            triangle_single.append(vertices_array[j])
-        triangle_single.append(triangle_single[0])
-        triangle_list.append(triangle_single)
-    return triangle_list
+
+def poisson_mesh_triangulation(point_cloud_array, depth, project_folder):
+    """
+    List based variant of poisson_mesh_triangle_array, kept for existing callers. Every triangle is returned as a
+    closed list of 4 points in absolute UTM coordinates.
+    """
+    triangle_a = poisson_mesh_triangle_array(point_cloud_array, depth, project_folder)
+    return np.concatenate((triangle_a, triangle_a[:, :1]), axis=1).tolist()
 
 
 def triangle_norming(triangles_a, utm_center):
@@ -1075,7 +1283,34 @@ def triangle_norming(triangles_a, utm_center):
     return triangles_a_normed
 
 
-def export_stl(project_folder, triangles_a, object_type):
+def triangle_array_norming(triangle_a, utm_center):
+    """
+    Array variant of triangle_norming: subtracts utm_center from every point in place and rounds to mm.
+    :param triangle_a: float array of shape (n, k, 3).
+    :param utm_center: The point that becomes the origin.
+    :return: The same, now normed, array.
+    """
+    triangle_a -= np.asarray(utm_center, dtype=triangle_a.dtype)
+    np.round(triangle_a, 3, out=triangle_a)
+    return triangle_a
+
+
+def as_triangle_array(triangles_a):
+    """
+    Turns any of the triangle containers used in this module (lists of closed 4 point triangles, object arrays from
+    import_stl, (n, 3, 3) arrays) into an (n, 3, 3) float array.
+    """
+    if isinstance(triangles_a, np.ndarray) and triangles_a.dtype != object and triangles_a.ndim == 3:
+        return triangles_a[:, :3]
+    return np.array([np.asarray(j, dtype=np.float64)[:3] for j in triangles_a]).reshape(-1, 3, 3)
+
+
+def stl_file_path(project_folder, object_type):
+    """
+    :param project_folder: Directory where the project is stored.
+    :param object_type: One of the STL object types, e.g. "Terrain" or "Target_Buildings".
+    :return: Path of the STL file of the object type, None for an unknown type.
+    """
     object_type_d = {"Terrain": "terrain.stl",
                      "Vegetation": "vegetation.stl",
                      "Target_Buildings": "target_buildings.stl",
@@ -1090,18 +1325,49 @@ def export_stl(project_folder, triangles_a, object_type):
     else:
         export_fp = os.path.join(project_folder, "DigitalTwin", "STLfiles")
 
-    num_triangles = len(triangles_a)
-    data = np.zeros(num_triangles, dtype=mesh.Mesh.dtype)
-    for i, j in enumerate(triangles_a):
-        data["vectors"][i] = np.array([j[0], j[1], j[2]])
-    m = mesh.Mesh(data)
+    if object_type not in object_type_d:
+        return None
+    return os.path.join(export_fp, object_type_d[object_type])
+
 
-    for key, value in object_type_d.items():
-        if object_type == key:
-            m.save(os.path.join(export_fp, value))
+def export_stl_array(project_folder, triangle_a, object_type):
+    """
+    Writes an (n, 3, 3) triangle array into the STL file of the given object type, streamed in chunks.
+    """
+    export_path = stl_file_path(project_folder, object_type)
+    if export_path is not None:
+        write_stl(export_path, triangle_chunks(triangle_a))
     # todo use logging package instead of print("%s type exported to stl." % type)
 
 
+def export_buildings_stl(project_folder, target_triangle_a, surrounding_triangle_a, utm_center,
+                         chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes the target, surrounding and combined building STL files in one pass. Every chunk is moved to utm_center,
+    packed into STL records once and written to its own file and to the combined file (target buildings first), so
+    the combined triangle set is never built in memory.
+    :param project_folder: Directory where the project is stored.
+    :param target_triangle_a: (n, 3, 3) array of the target building triangles in UTM coordinates.
+    :param surrounding_triangle_a: (m, 3, 3) array of the surrounding building triangles in UTM coordinates.
+    :param utm_center: The point that becomes the origin of the STL files.
+    :param chunk_size: Number of triangles packed at a time.
+    """
+    with BinaryStlWriter(stl_file_path(project_folder, "Target_Buildings")) as target_stl, \
+            BinaryStlWriter(stl_file_path(project_folder, "Surrounding_Buildings")) as surrounding_stl, \
+            BinaryStlWriter(stl_file_path(project_folder, "Buildings")) as buildings_stl:
+        for triangle_a, stl_file in ((target_triangle_a, target_stl), (surrounding_triangle_a, surrounding_stl)):
+            for chunk in triangle_chunks(triangle_a, chunk_size, utm_center):
+                records = triangle_records(chunk)
+                stl_file.write_records(records)
+                buildings_stl.write_records(records)
+    print('building STL files exported:', target_stl.count, 'target and', surrounding_stl.count,
+          'surrounding triangles.')
+
+
+def export_stl(project_folder, triangles_a, object_type):
+    export_stl_array(project_folder, as_triangle_array(triangles_a), object_type)
+
+
 def calculate_distance_to_target_building(building_center_utm_a, target_building_location_a):
     """
     Calculates the distance between the target building and the examined building.
@@ -1116,10 +1382,7 @@ def calculate_distance_to_target_building(building_center_utm_a, target_building
 
 
 def add_to_gml_d(gml_d, target_building_location_a, utm_zone, zone_letter, element, float_a, counter):
-    polygon_np_a = np.array_split(np.array(float_a), (len(float_a) / 3))
-    polygon_a = []
-    for triple in polygon_np_a:
-        polygon_a.append(list(triple))
+    polygon_a = np.asarray(float_a, dtype=np.float64).reshape(-1, 3).tolist()
 
     if element == "GROUND":
         easting = 0
@@ -1148,71 +1411,23 @@ def add_to_gml_d(gml_d, target_building_location_a, utm_zone, zone_letter, eleme
     return gml_d
 
 
-def parse_line(line, polygon_marker, parsing_d):
-    line = line.strip("\n")
-    line = line.strip("\t")
-    line = line.replace(polygon_marker, "")
-    line = line.strip(parsing_d["PolygonEnd"])
-    line_a = line.split(" ")
-    return line_a
-
-
-def parse_gml_elements(building_a, building_name, parsing_d, target_building_location_a, perimeter, county):
+def gml_building_to_gml_d(building, parsing_d, target_building_location_a, perimeter):
     """
-    :param building_a: The specific building array in a given GML file that is being parsed through.
-    :param building_name: The name of the building of concern.
+    Builds the building dictionary of a record streamed by citygml_reader.iter_gml_buildings.
+    :param building: Building record with the gml id and the (element, counter, polygon array) surfaces.
     :param parsing_d: The county specific dictionary that contains data necessary for parsing the GML files.
     :param target_building_location_a: Location of the target building - used to calculate the distance between
     the target building and the building that is currently being parsed.
     :param perimeter: Perimeter around the target building that is being used to take into account the
     buildings that are located within it.
-    :param county: County where the target building is located
     :return gml_d: Building specific dictionary containing the ID, LatLon, UTM center, Distance to the
-    target building and the surfaces of the building.
+    target building and the surfaces of the building. None if the building is outside of the perimeter.
     """
-    gml_d = {"ID": building_name, "surfaces": []}
+    gml_d = {"ID": building["ID"], "surfaces": []}
     utm_zone = parsing_d["UTMZone"]
     zone_letter = parsing_d["ZoneLetter"]
-
-    for key in parsing_d["Elements"]:
-        element = key["ELEMENT"]
-        element_marker_start = key["ELEMENTSTART"]
-        element_marker_end = key["ELEMENTEND"]
-        polygon_marker = parsing_d["PolygonStart"]
-
-        counter = 0
-        element_found = False
-
-        for line in building_a:
-
-            if element_marker_start in line:
-                element_found = True
-                counter += 1
-                if county == 'Hamburg':
-                    float_a = []
-
-            if polygon_marker in line and element_found:
-                if county != 'Hamburg':
-                    float_a = []
-                line = line.strip("\n")
-                line = line.strip("\t")
-                line = line.replace(polygon_marker, "")
-                line = line.strip(parsing_d["PolygonEnd"])
-                line_a = line.split(" ")
-                line_a = [el for el in line_a if el != '']
-
-                # line_a = parse_line(line, polygon_marker, parsing_d)
-                for coordinate in line_a:
-                    float_a.append(float(coordinate))
-                if county != 'Hamburg':
-                    gml_d = add_to_gml_d(gml_d, target_building_location_a, utm_zone, zone_letter, element,
-                                         float_a, counter)
-
-            if element_marker_end in line:
-                element_found = False
-                if county == 'Hamburg':
-                    gml_d = add_to_gml_d(gml_d, target_building_location_a, utm_zone, zone_letter, element,
-                                         float_a, counter)
+    for element, counter, polygon in building["surfaces"]:
+        gml_d = add_to_gml_d(gml_d, target_building_location_a, utm_zone, zone_letter, element, polygon, counter)
     try:
         if gml_d["Distance"] < perimeter and len(gml_d["surfaces"]) > 1:
             return gml_d
@@ -1222,6 +1437,30 @@ def parse_gml_elements(building_a, building_name, parsing_d, target_building_loc
         return
 
 
+def building_candidate_filter(target_building_centroid, perimeter, hulls):
+    """
+    Builds the spatial pre-filter of the GML buildings. A building is a candidate if its ground footprint box is
+    closer to the target building than the perimeter and overlaps the box of at least one KML hull. The building
+    center used later on is rounded to the metre, so both tests allow 1 m of slack.
+    :param target_building_centroid: The UTM coordinates of the target building's centroid.
+    :param perimeter: Perimeter around the target building.
+    :param hulls: The target and surrounding building hulls of the KML file.
+    :return: Function (min_x, min_y, max_x, max_y) -> bool.
+    """
+    center_x, center_y = float(target_building_centroid[0]), float(target_building_centroid[1])
+    hull_boxes = np.array([np.concatenate((np.min(hull, axis=0), np.max(hull, axis=0)))
+                           for hull in hulls if len(hull)]).reshape(-1, 4)
+
+    def is_candidate(min_x, min_y, max_x, max_y):
+        nearest_x = min(max(center_x, min_x), max_x)
+        nearest_y = min(max(center_y, min_y), max_y)
+        if np.hypot(center_x - nearest_x, center_y - nearest_y) > perimeter + 1:
+            return False
+        return bool(np.any((hull_boxes[:, 0] <= max_x + 1) & (hull_boxes[:, 2] >= min_x - 1) &
+                           (hull_boxes[:, 1] <= max_y + 1) & (hull_boxes[:, 3] >= min_y - 1)))
+    return is_candidate
+
+
 def creating_2d_convex_hull(points):
     """
     The function takes points as XY coordinates, creates the smallest possible polygon containing all the points and
@@ -1254,20 +1493,43 @@ def hull_check(points):
     return hulls
 
 
-def point_in_polygon(center_point, polygon_a):
+class HullIndex:
     """
-    This function takes a point and an array defining a polygon and checks if the given point is inside the polygon
-    :param center_point: An array containing the UTM coordinates of the point
-    :param polygon_a: The convex hull created from points located on the building's surfaces that are not walls.
-    :return: Boolean expression. True if the polygon contains the point, False otherwise.
+    Index over the KML hulls for testing many building centres against many hulls at once. With Shapely 2 the hull
+    polygons are kept in an STRtree that is queried in bulk; Shapely 1.8 has no bulk query, there every hull is tested
+    against the points in its bounding box with the vectorized contains predicate.
     """
-    shp_point = Point(center_point)
-    shp_polygon = Polygon(polygon_a)
-    return shp_polygon.contains(shp_point)
+
+    def __init__(self, hulls):
+        self.polygons = [Polygon(hull) for hull in hulls]
+        # shapely.points (and with it the bulk STRtree query with a predicate) only exists from Shapely 2 on
+        self.tree = STRtree(self.polygons) if self.polygons and hasattr(shapely, 'points') else None
+
+    def contains_points(self, points):
+        """
+        :param points: List or array of [x, y] points.
+        :return: Boolean array, True where a point lies in any of the hulls.
+        """
+        inside = np.zeros(len(points), dtype=bool)
+        if not self.polygons or len(points) == 0:
+            return inside
+        points = np.asarray(points, dtype=np.float64)
+        x = points[:, 0]
+        y = points[:, 1]
+        if self.tree is not None:
+            point_positions = self.tree.query(shapely.points(x, y), predicate='within')[0]
+            inside[point_positions] = True
+            return inside
+        for polygon in self.polygons:
+            min_x, min_y, max_x, max_y = polygon.bounds
+            rows = np.nonzero(~inside & (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y))[0]
+            if len(rows):
+                inside[rows] = contains_xy(polygon, x[rows], y[rows])
+        return inside
 
 
 def split_gml_cloud(server_address, access_token, project_folder, project_id, county,
-                    target_building_centroid, points_buildings, target_shape):
+                    target_building_centroid, points_buildings, target_shape, upload_workers=8):
     gml_folder = os.path.join(project_folder, 'GeospatialData', 'GML')
     current_path = os.path.join(INPUT_FILES_FP, 'CountySpecs')
     county_spec_file = os.path.join(current_path, county + '.json')
@@ -1278,16 +1540,11 @@ def split_gml_cloud(server_address, access_token, project_folder, project_id, co
         points_buildings, target_building_centroid)
     hull_target = hull_check(target_shape)
     hull_surroundings = hull_check(points_buildings)
+    target_index = HullIndex(hull_target)
+    surroundings_index = HullIndex(hull_surroundings)
 
-    get_max_items = get_request(
-        server_address, access_token, "surroundings/buildings", projectId=project_id)
-    max_items = get_max_items['maxItems']
-    if max_items == 0:
-        max_items = 1
-    get_project_buildings = get_request(server_address, access_token, "surroundings/buildings", projectId=project_id,
-                                        limit=max_items)
     building_list = []
-    for building in get_project_buildings['list']:
+    for building in iter_get_request(server_address, access_token, "surroundings/buildings", projectId=project_id):
         building_list.append(building['name'])
 
     target_buildings_list = []
@@ -1295,100 +1552,81 @@ def split_gml_cloud(server_address, access_token, project_folder, project_id, co
         if 'TB_' in tb:
             target_buildings_list.append(tb[3:])
 
+    surface_tags = surface_tags_from_parsing_d(parsing_d)
+    # only buildings whose footprint can pass the perimeter and hull tests below are fully decoded
+    candidate_filter = building_candidate_filter(target_building_centroid, max_distance_buildings,
+                                                 list(hull_surroundings) + list(hull_target))
     gml_list = os.listdir(gml_folder)
-    for gml_file in gml_list:
-        gml_file_name = os.path.join(gml_folder, gml_file)
-        # "<bldg:Building gml:id="
-        building_start_s = parsing_d["BuildingStart"]
-        # building ending
-        building_end_s = parsing_d["BuildingEnd"]  # "/bldg:Building>"
-        gml_load = open(gml_file_name, "r")
-        building_found = False
-        building_counter = 0
-        for line in gml_load:
-            if building_start_s in line:
-                gml_id = line.strip(" ")
-                gml_id = gml_id.strip("\n")
-                gml_id = gml_id.replace(building_start_s, "")
-                gml_id = gml_id.replace("\"", "")
-                gml_id = gml_id.replace(">", "")
-                gml_id = gml_id.strip("\t")
-
-                building_found = True
-                building_drop_a = []
-                building_counter += 1
-            # If the end of a building system is found the data is assessed
-            # If the building analyzed is in the target perimeter the data will be dumped into a .json file
-            if building_end_s in line:
-                building_found = False
-                gml_d = parse_gml_elements(building_drop_a, gml_id, parsing_d, target_building_centroid,
-                                           max_distance_buildings,
-                                           county)
+    # the buildings are uploaded in the background while the next GML file is parsed; leaving the with block waits
+    # for the queued uploads, also when parsing fails
+    with ConcurrentUploader(server_address, access_token, workers=upload_workers) as uploader:
+        for gml_file in gml_list:
+            gml_file_name = os.path.join(gml_folder, gml_file)
+            # buildings are streamed one at a time; the surfaces are read by tag, not by line markers
+            candidates = []
+            for building in iter_gml_buildings(gml_file_name, surface_tags, candidate_filter):
+                gml_d = gml_building_to_gml_d(building, parsing_d, target_building_centroid, max_distance_buildings)
                 if gml_d is not None:
-
-                    check_points = gml_d['UTMCenter']
-                    for i in gml_d['surfaces']:
-                        if i['surface_type'] == 'GROUND':
-                            check_points.extend(
-                                np.array(i['polygon'])[:, :2].tolist())
-
-                    for hull in hull_surroundings:
-                        if point_in_polygon(check_points, hull):
-                            if "SB_" + gml_d['ID'] not in building_list and gml_d['ID'] not in target_buildings_list:
-                                # gml_d['ID'] = "SB_" + gml_d['ID']
-                                lat_lon = utm.to_latlon(gml_d['UTMCenter'][0],
-                                                        gml_d['UTMCenter'][1],
-                                                        32, 'U')
-                                surrounding_building_payload = {
-                                    "projectId": project_id,
-                                    "name": "SB_" + gml_d['ID'],
-                                    "quadrant": str(gml_d['UTMCenter'][0])[:3] + '-' + str(gml_d['UTMCenter'][1])[:4],
-                                    "latitude": round(lat_lon[0], 4),
-                                    "longitude": round(lat_lon[1], 4),
-                                    "utmX": gml_d['UTMCenter'][0],
-                                    "utmY": gml_d['UTMCenter'][1],
-                                    "distance": gml_d['Distance'],
-                                    "target": 'false',
-                                    "data": str(gml_d['surfaces'])
-                                }
-                                # print(surrounding_building_payload['name'])
-                                payload_surrounding_building_json = json.dumps(
-                                    surrounding_building_payload)
-                                post_request(server_address, access_token, "surroundings/buildings",
-                                             payload_surrounding_building_json)
-                                # sb_folder.append(gml_d['ID'])
-                                building_list.append("SB_" + gml_d['ID'])
-                            else:
-                                print(
-                                    'surrounding building already exists in the database.', 'id sb', gml_d['ID'])
-                    for hull in hull_target:
-                        if point_in_polygon(check_points, hull):
-                            if "TB_" + gml_d['ID'] not in building_list:
-                                # gml_d['ID'] = "TB_" + gml_d['ID']
-                                lat_lon = utm.to_latlon(gml_d['UTMCenter'][0],
-                                                        gml_d['UTMCenter'][1],
-                                                        32, 'U')
-                                target_building_payload = {
-                                    "projectId": project_id,
-                                    "name": "TB_" + gml_d['ID'],
-                                    "quadrant": str(gml_d['UTMCenter'][0])[:3] + '-' + str(gml_d['UTMCenter'][1])[:4],
-                                    "latitude": round(lat_lon[0], 4),
-                                    "longitude": round(lat_lon[1], 4),
-                                    "utmX": gml_d['UTMCenter'][0],
-                                    "utmY": gml_d['UTMCenter'][1],
-                                    "distance": gml_d['Distance'],
-                                    "target": 'true',
-                                    "data": str(gml_d['surfaces'])
-                                }
-                                payload_target_building_json = json.dumps(
-                                    target_building_payload)
-                                post_request(server_address, access_token, "surroundings/buildings",
-                                             payload_target_building_json)
-                            else:
-                                print(
-                                    'target building already exists in the database.', 'tb id', gml_d['ID'])
-            if building_found:
-                building_drop_a.append(line.strip("\n"))
+                    candidates.append(gml_d)
+            if not candidates:
+                continue
+
+            centres = [gml_d['UTMCenter'][:2] for gml_d in candidates]
+            in_surroundings = surroundings_index.contains_points(centres)
+            in_target = target_index.contains_points(centres)
+            for gml_d, is_surrounding, is_target in zip(candidates, in_surroundings, in_target):
+                if is_surrounding:
+                    if "SB_" + gml_d['ID'] not in building_list and gml_d['ID'] not in target_buildings_list:
+                        lat_lon = utm.to_latlon(gml_d['UTMCenter'][0],
+                                                gml_d['UTMCenter'][1],
+                                                32, 'U')
+                        surrounding_building_payload = {
+                            "projectId": project_id,
+                            "name": "SB_" + gml_d['ID'],
+                            "quadrant": str(gml_d['UTMCenter'][0])[:3] + '-' + str(gml_d['UTMCenter'][1])[:4],
+                            "latitude": round(lat_lon[0], 4),
+                            "longitude": round(lat_lon[1], 4),
+                            "utmX": gml_d['UTMCenter'][0],
+                            "utmY": gml_d['UTMCenter'][1],
+                            "distance": gml_d['Distance'],
+                            "target": 'false',
+                            "data": encode_surfaces(gml_d['surfaces'])
+                        }
+                        payload_surrounding_building_json = json.dumps(
+                            surrounding_building_payload)
+                        uploader.submit("surroundings/buildings", payload_surrounding_building_json,
+                                        surrounding_building_payload["name"])
+                        building_list.append("SB_" + gml_d['ID'])
+                    else:
+                        print(
+                            'surrounding building already exists in the database.', 'id sb', gml_d['ID'])
+                if is_target:
+                    if "TB_" + gml_d['ID'] not in building_list:
+                        lat_lon = utm.to_latlon(gml_d['UTMCenter'][0],
+                                                gml_d['UTMCenter'][1],
+                                                32, 'U')
+                        target_building_payload = {
+                            "projectId": project_id,
+                            "name": "TB_" + gml_d['ID'],
+                            "quadrant": str(gml_d['UTMCenter'][0])[:3] + '-' + str(gml_d['UTMCenter'][1])[:4],
+                            "latitude": round(lat_lon[0], 4),
+                            "longitude": round(lat_lon[1], 4),
+                            "utmX": gml_d['UTMCenter'][0],
+                            "utmY": gml_d['UTMCenter'][1],
+                            "distance": gml_d['Distance'],
+                            "target": 'true',
+                            "data": encode_surfaces(gml_d['surfaces'])
+                        }
+                        payload_target_building_json = json.dumps(
+                            target_building_payload)
+                        uploader.submit("surroundings/buildings", payload_target_building_json,
+                                        target_building_payload["name"])
+                    else:
+                        print(
+                            'target building already exists in the database.', 'tb id', gml_d['ID'])
+    print(len(uploader.report), 'buildings uploaded to the database.')
+    if uploader.failed():
+        print('buildings that could not be uploaded:', uploader.failed())
 
 
 def delete_request(server_address, access_token, table_path, item_id):
@@ -1402,35 +1640,19 @@ def delete_request(server_address, access_token, table_path, item_id):
     :param table_path: The specific sub-location of a given table on the server.
     :param item_id: The ID of the item that we want to delete.
     """
-    payload_json = {}
-    headers = {
-        'Authorization': 'Bearer %s' % access_token,
-        'Content-Type': 'application/json'
-    }
-    address = os.path.join(server_address, table_path, str(item_id))
-    address = address.replace('\\', '/')
-    response = requests.request(
-        "DELETE", address, headers=headers, data=payload_json)
+    response = get_client(server_address).delete(table_path, item_id, access_token=access_token)
     print(response.text.encode('utf8'))
 
 
 def remove_overlapping_sb(server_address, access_token, project_id):
-    get_sb_items = get_request(server_address, access_token, 'surroundings/buildings', projectId=project_id,
-                               target='false')
-    sb_items = get_sb_items['maxItems']
-
-    get_buildings_s = get_request(server_address, access_token, 'surroundings/buildings', projectId=project_id,
-                                  limit=sb_items,
-                                  target='false')
-    get_buildings_t = get_request(server_address, access_token, 'surroundings/buildings', projectId=project_id,
-                                  limit=100,
-                                  target='true')
     sb = {}
-    for b in get_buildings_s['list']:
+    for b in iter_get_request(server_address, access_token, 'surroundings/buildings', projectId=project_id,
+                              target='false'):
         sb[b['name'][3:]] = b['id']
 
     tb = {}
-    for b in get_buildings_t['list']:
+    for b in iter_get_request(server_address, access_token, 'surroundings/buildings', projectId=project_id,
+                              target='true'):
         tb[b['name'][3:]] = b['id']
 
     for key, items in sb.items():
@@ -1634,37 +1856,76 @@ def triangulate_tetragon(polygon_a):
 def triangulate_polygon_with_higher_than_5_points(polygon_a):
     """
     Function that is used to triangulate polygons that have arrays with more than 5 points. For this purpose, the
-    Delaunay meshing method is being used.
+    polygon is triangulated by ear clipping, which follows the outline of concave roofs and gives n - 2 triangles for
+    a polygon of n points.
     :param polygon_a: The array of the polygon that we want to mesh
     :return: Array of arrays that contain the individual triangles resulting from the meshing.
     """
-    new_surface = Surface(polygon_a)
-    projected_polygon = new_surface.projectedPolygon
-    delaunay_mesh = Delaunay(projected_polygon)
-    mesh_simplices = delaunay_mesh.simplices
-
-    meshed_triangles = []
-    for simplex in mesh_simplices:
-        meshed_individual = []
-        for position in simplex:
-            meshed_individual.append(polygon_a[position])
-        meshed_individual.append(polygon_a[simplex[0]])
-        # if Polygon(projected_polygon).is_valid:
-        if Polygon(meshed_individual).within(Polygon(projected_polygon)):
-            meshed_triangles.append(meshed_individual)
-        else:
-            print('invalid polygon')
-    return meshed_triangles
+    return ear_clipping_triangles(polygon_a)
 
 
-def triangulate_static_shading_influences_cloud(project_folder, server_address, access_token, project_id, target):
+def triangulate_surface(polygon):
+    """
+    Triangulates a single surface polygon. The method depends on the number of points of the polygon, see
+    triangulate_static_shading_influences_cloud.
+    :param polygon: polygon array in the form [[x1,y1,z1],[x2,y2,z2],[...],...]
+    :return triangles, faulty: List of the resulting triangles, and True if the polygon is invalid.
+    """
+    triangles = []
+    polygon_instance = Surface(polygon)
+    projected_polygon = polygon_instance.projectedPolygon
+    if not Polygon(projected_polygon).is_valid:
+        if polygon_instance.tilt_f < 80.0:
+            projected_polygon = creating_2D_convex_hull(
+                projected_polygon)
+    if Polygon(projected_polygon).is_valid:
+        if len(polygon) == 5:
+            triangles_a = triangulate_tetragon(polygon)
+            triangles.append(triangles_a[0])
+            triangles.append(triangles_a[1])
+
+        if len(polygon) < 5:
+            triangles.append(polygon)
+
+        if len(polygon) > 5:
+            tri_lists = triangulate_polygon_with_higher_than_5_points(
+                polygon)
+            for a in tri_lists:
+                triangles.append(a)
+    elif not Polygon(polygon).is_valid:
+        return triangles, True
+    return triangles, False
+
+
+def triangulate_building_data(building_data):
+    """
+    Decodes and triangulates the surfaces of a number of buildings; the unit of work of the triangulation pool.
+    The triangles are returned as one float64 array per building, which is much cheaper to send back from a worker
+    process than nested lists. float64 is kept on purpose: float32 would round the UTM northings to half a metre.
+    Buildings whose triangles do not all have 4 points keep the list.
+    :param building_data: List of the data fields of the buildings.
+    :return: List of (triangles, faulty surfaces) tuples, one per building.
+    """
+    results = []
+    for data in building_data:
+        surfaces = decode_surfaces(data)
+        triangles, faulty_positions = triangulate_polygons([surface_elements['polygon'] for surface_elements in
+                                                            surfaces], triangulate_surface)
+        if triangles and all(len(triangle) == 4 for triangle in triangles):
+            triangles = np.array(triangles, dtype=np.float64)
+        results.append((triangles, [surfaces[position] for position in faulty_positions]))
+    return results
+
+
+def triangulate_static_shading_influences_cloud(project_folder, server_address, access_token, project_id, target,
+                                                workers=1, as_array=False):
     """
     This function takes the buildings of a given project and triangulates the surfaces of the buildings.
     The method used for triangulation depends on the number of points that the array of a given surface has. If there
     are 5 points in the surface, we use the triangulate_tetragon function which splits the surface in two triangles.
     If the array has 4 points, and the first one and the last one are the same, that surface is already a triangle. If
-    the array has more than 5 points, we use the triangulate_polygon_with_higher_than_5_points, which uses the Delaunay
-    triangulation method.
+    the array has more than 5 points, we use the triangulate_polygon_with_higher_than_5_points, which uses ear
+    clipping.
 
     Additionally, if we have invalid surface polygons, they are all stored in a dictionary for further review.
 
@@ -1676,47 +1937,39 @@ def triangulate_static_shading_influences_cloud(project_folder, server_address,
     groups, the user's privileges, and, in some cases, a particular application. Access tokens only have a limited
     lifetime.
     :param project_id: The id of the project in the database.
+    :param workers: Number of worker processes the buildings are sharded over. None uses one per CPU core, 1
+    triangulates everything in this process. The result is the same in both cases.
+    :param as_array: Returns the triangles as one (n, 3, 3) float64 array instead of a list of closed triangles.
     :return: Array of arrays that contains the resulting triangles.
     """
-    get_max_items = get_request(server_address, access_token, "surroundings/buildings", projectId=project_id,
-                                target=target)
-    maxItems = get_max_items['maxItems']
-    get_buildings = get_request(server_address, access_token, "surroundings/buildings", projectId=project_id,
-                                limit=maxItems, target=target)
+    get_buildings = get_cached_list(server_address, access_token, "surroundings/buildings", projectId=project_id,
+                                    target=target)
+
+    building_data = [items['data'] for items in get_buildings]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(building_data))
+    if workers <= 1:
+        building_results = triangulate_building_data(building_data)
+    else:
+        # contiguous shards, several per worker to even out large and small buildings; map keeps the order
+        shard_size = max(1, -(-len(building_data) // (workers * 4)))
+        shards = [building_data[i:i + shard_size] for i in range(0, len(building_data), shard_size)]
+        building_results = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for shard_results in executor.map(triangulate_building_data, shards):
+                building_results.extend(shard_results)
 
     triangles_static_l = []
     faulty_polygons_total = {}
-    for items in get_buildings['list']:
-        surfaces = ast.literal_eval(items['data'])
-        faulty_polygons_total[items['name']] = []
-        for surface_elements in surfaces:
-            polygon = surface_elements['polygon']
-            polygon_instance = Surface(polygon)
-            projected_polygon = polygon_instance.projectedPolygon
-            if not Polygon(projected_polygon).is_valid:
-                # print(surface_elements['ID'])
-                if polygon_instance.tilt_f < 80.0:
-                    # print(items['name'], surface_elements['ID'])
-                    projected_polygon = creating_2D_convex_hull(
-                        projected_polygon)
-            if Polygon(projected_polygon).is_valid:
-                if len(polygon) == 5:
-                    triangles_a = triangulate_tetragon(polygon)
-                    triangles_static_l.append(triangles_a[0])
-                    triangles_static_l.append(triangles_a[1])
-
-                if len(polygon) < 5:
-                    triangles_static_l.append(polygon)
-
-                if len(polygon) > 5:
-                    tri_lists = triangulate_polygon_with_higher_than_5_points(
-                        polygon)
-                    for a in tri_lists:
-                        triangles_static_l.append(a)
-            elif not Polygon(polygon).is_valid:
-                # print(Polygon(polygon).is_valid, polygon, items['name'], surface_elements['ID'])
-                # print('fp', faulty_polygons_total)
-                faulty_polygons_total[items['name']].append(surface_elements)
+    for items, (triangles, faulty_surfaces) in zip(get_buildings, building_results):
+        if as_array:
+            triangles_static_l.append(as_triangle_array(triangles))
+        else:
+            if isinstance(triangles, np.ndarray):
+                triangles = triangles.tolist()
+            triangles_static_l.extend(triangles)
+        faulty_polygons_total[items['name']] = faulty_surfaces
 
     empty_keys = []
     for key in faulty_polygons_total.keys():
@@ -1734,6 +1987,8 @@ def triangulate_static_shading_influences_cloud(project_folder, server_address,
         json.dump(faulty_polygons_total, f)
     print('The faulty polygons have been stored in the project folder.')
 
+    if as_array:
+        return np.concatenate(triangles_static_l) if triangles_static_l else np.zeros((0, 3, 3))
     return triangles_static_l
 
 
@@ -1758,8 +2013,7 @@ for project in os.listdir(main_project_folder):
 
 
 def project_setup(config_file, customer_id, server_address, access_token):
-    get_existing_projects = get_request(
-        server_address, access_token, 'projects', limit=10000)['list']
+    get_existing_projects = iter_get_request(server_address, access_token, 'projects')
     existing_projects_d = {project['name']: project['id']
                            for project in get_existing_projects}
     if config_file['ProjectName'] in existing_projects_d:
@@ -1792,8 +2046,7 @@ def project_setup(config_file, customer_id, server_address, access_token):
 
 def customer_setup(customer_name, customer_language, server_address, access_token):
     print('server address', server_address)
-    get_existing_customers = get_request(
-        server_address, access_token, "customer", limit=10000)['list']
+    get_existing_customers = iter_get_request(server_address, access_token, "customer")
     existing_customer_d = {customer['name']: customer['id']
                            for customer in get_existing_customers}
     if customer_name in existing_customer_d:
@@ -1816,11 +2069,10 @@ def customer_setup(customer_name, customer_language, server_address, access_toke
         return customer_id
 
 
-def import_stl(mesh_file):
-    triangles_meshed = np.empty(len(mesh_file), dtype=object)
-    for position, data in enumerate(mesh_file.data):
-        data_new = data[1].tolist()
-        data_new.append(data[1][0].tolist())
-        data_new_a = np.array(data_new)
-        triangles_meshed[position] = data_new_a
-    return triangles_meshed
+def import_stl(stl_file_path):
+    """
+    Reads an STL file through the memory-mapped reader, without building a numpy-stl mesh.
+    :param stl_file_path: Path of the STL file.
+    :return: (n, 4, 3) float64 array of the closed triangles of the mesh.
+    """
+    return closed_triangle_array(read_stl(stl_file_path))
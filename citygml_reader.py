@@ -0,0 +1,120 @@
+import numpy as np
+from lxml import etree
+
+GML_ID = '{http://www.opengis.net/gml}id'
+
+# used when the county specification does not list the surface elements
+DEFAULT_SURFACE_TAGS = [('WALL', 'WallSurface'), ('ROOF', 'RoofSurface'), ('GROUND', 'GroundSurface')]
+
+
+def surface_tags_from_parsing_d(parsing_d):
+    """
+    Reads the surface elements of the county specification (CountySpecs/*.json) as (ELEMENT, tag name) pairs,
+    e.g. ("WALL", "WallSurface") from "<bldg:WallSurface gml:id=". Only the tag name is used, so the line layout of
+    the GML files does not matter any more.
+    :param parsing_d: The county specific dictionary that contains data necessary for parsing the GML files.
+    :return: List of (element, local tag name) tuples, in the order of the specification.
+    """
+    surface_tags = []
+    for key in parsing_d.get("Elements", []):
+        tag = key["ELEMENTSTART"].strip().lstrip("<").split()[0]
+        surface_tags.append((key["ELEMENT"], tag.split(":")[-1]))
+    return surface_tags or DEFAULT_SURFACE_TAGS
+
+
+def ring_coordinates(ring):
+    """
+    Reads the coordinates of a gml:LinearRing, either from one gml:posList or from a sequence of gml:pos elements.
+    :return: (n, 3) float array of the ring coordinates, None if the ring has no usable coordinates.
+    """
+    texts = [element.text for element in ring.iter('{*}posList', '{*}pos') if element.text]
+    if not texts:
+        return None
+    float_a = np.array(" ".join(texts).split(), dtype=np.float64)
+    if len(float_a) == 0 or len(float_a) % 3:
+        return None
+    return float_a.reshape(-1, 3)
+
+
+def building_surfaces(building, surface_tags):
+    """
+    Collects the polygons of every surface element of a building. The surfaces are grouped by element in the order
+    of surface_tags; the counter of an element increases with every surface element of that type, and all rings of
+    one surface element share its counter.
+    :return: List of (element, counter, polygon array) tuples.
+    """
+    surfaces = []
+    for element, tag in surface_tags:
+        counter = 0
+        for surface in building.iter('{*}' + tag):
+            counter += 1
+            for ring in surface.iter('{*}LinearRing'):
+                polygon = ring_coordinates(ring)
+                if polygon is not None:
+                    surfaces.append((element, counter, polygon))
+    return surfaces
+
+
+def footprint_bbox(building, ground_tag):
+    """
+    Bounding box of the ground surfaces of a building. Only the ground rings are decoded, which makes this a cheap
+    first look at a building before all of its surfaces are read.
+    :return: (min_x, min_y, max_x, max_y), None if the building has no ground surface.
+    """
+    rings = []
+    for surface in building.iter('{*}' + ground_tag):
+        for ring in surface.iter('{*}LinearRing'):
+            polygon = ring_coordinates(ring)
+            if polygon is not None:
+                rings.append(polygon)
+    if not rings:
+        return None
+    points = np.concatenate(rings)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+
+def release_element(element):
+    """
+    Frees a processed element and everything parsed before it, so memory stays flat on large files.
+    """
+    element.clear()
+    for ancestor in element.iterancestors():
+        while ancestor.getprevious() is not None:
+            del ancestor.getparent()[0]
+
+
+def iter_gml_buildings(gml_file_path, surface_tags=None, building_filter=None):
+    """
+    Streams the buildings of a CityGML file in a single pass with lxml.etree.iterparse. Every bldg:Building element
+    is turned into a record as soon as it is closed and is released right after, including the building parts
+    nested in it.
+
+    With a building_filter, only the ground footprint of a building is decoded first and passed to the filter as a
+    bounding box; the other surfaces are decoded only if the filter accepts it. Buildings without a ground surface
+    are skipped in that case, as they can not be placed.
+    :param gml_file_path: Path of the GML file.
+    :param surface_tags: List of (element, local tag name) tuples of the surfaces to read.
+    :param building_filter: Optional function (min_x, min_y, max_x, max_y) -> bool.
+    :return: Generator of {"ID": gml id, "surfaces": [(element, counter, polygon array), ...]} records.
+    """
+    if surface_tags is None:
+        surface_tags = DEFAULT_SURFACE_TAGS
+    ground_tag = dict(surface_tags).get('GROUND', 'GroundSurface')
+    building_count = 0
+    candidate_count = 0
+    for _, building in etree.iterparse(gml_file_path, events=('end',), tag='{*}Building', huge_tree=True):
+        building_count += 1
+        if building_filter is not None:
+            bbox = footprint_bbox(building, ground_tag)
+            if bbox is None or not building_filter(*bbox):
+                release_element(building)
+                continue
+        candidate_count += 1
+        gml_id = building.get(GML_ID)
+        if gml_id is None:
+            gml_id = next((value for key, value in building.attrib.items() if key.endswith('id')), None)
+        record = {"ID": gml_id, "surfaces": building_surfaces(building, surface_tags)}
+        release_element(building)
+        yield record
+    if building_filter is not None:
+        print(gml_file_path, ':', candidate_count, 'of', building_count, 'buildings passed the spatial pre-filter.')
@@ -1,17 +1,15 @@
 import os
-import requests
 import shutil
-import time
 import gzip
 import zipfile
-from subprocess import call
+from tile_downloader import TileDownloader
+from tile_index import TileIndex
+from tile_store import TileIngestPool, tile_store_path
 
 
-def geo_data_download(project_folder, county, unique_list_layers):
-    dir_path = r"/Users/jules/Downloads"
-    download_start_time = None
-    r = None
-    filename = None
+def geo_data_download(project_folder, county, unique_list_layers, download_workers=4):
+    downloader = TileDownloader(project_folder, county, workers=download_workers)
+    ingest_pool = TileIngestPool(project_folder)
 
     if county == 'Hamburg':
         gml_base = r"G:\Shared drives\CityGML-DataBase\Germany\Hamburg"
@@ -21,6 +19,10 @@ def geo_data_download(project_folder, county, unique_list_layers):
         gml_folder = os.path.join(project_folder, 'GeospatialData', 'GML')
         dtm_folder = os.path.join(project_folder, 'GeospatialData', 'DTM')
         dsm_folder = os.path.join(project_folder, 'GeospatialData', 'DSM')
+        tile_cache = downloader.tile_cache
+        gml_index = TileIndex(gml_base)
+        dsm_index = TileIndex(dsm_base)
+        dtm_index = TileIndex(dtm_base)
 
         for layer in unique_list_layers:
             for key in layer:
@@ -29,23 +31,20 @@ def geo_data_download(project_folder, county, unique_list_layers):
                     for y in layer[key][1]:
                         zip_file_addon = str(x) + "_" + str(y)
                         if key == 'GML':
-                            for i in os.listdir(gml_base):
-                                if i[5:13] == zip_file_addon:
-                                    print(zip_file_addon)
-                                    shutil.copy2(os.path.join(
-                                        gml_base, i), gml_folder)
+                            for i in gml_index.lookup(key, zip_file_addon):
+                                print(zip_file_addon)
+                                tile_cache.materialise(tile_cache.put_file(
+                                    os.path.join(gml_base, i), county, key), os.path.join(gml_folder, i))
                         if key == 'DSM':
-                            for i in os.listdir(dsm_base):
-                                if i[7:15] == zip_file_addon:
-                                    print(zip_file_addon)
-                                    shutil.copy2(os.path.join(
-                                        dsm_base, i), dsm_folder)
+                            for i in dsm_index.lookup(key, zip_file_addon):
+                                print(zip_file_addon)
+                                tile_cache.materialise(tile_cache.put_file(
+                                    os.path.join(dsm_base, i), county, key), os.path.join(dsm_folder, i))
                         if key == 'DTM':
-                            for i in os.listdir(dtm_base):
-                                if i[7:15] == zip_file_addon:
-                                    print(zip_file_addon)
-                                    shutil.copy2(os.path.join(
-                                        dtm_base, i), dtm_folder)
+                            for i in dtm_index.lookup(key, zip_file_addon):
+                                print(zip_file_addon)
+                                tile_cache.materialise(tile_cache.put_file(
+                                    os.path.join(dtm_base, i), county, key), os.path.join(dtm_folder, i))
 
     if county == 'Brandenburg':
         url_base = r"https://data.geobasis-bb.de/geobasis/daten/"
@@ -138,34 +137,39 @@ def geo_data_download(project_folder, county, unique_list_layers):
                     zip_file_name = key_list[1] + zip_file_addon + key_list[2]
                     download_url_name = key_list[0] + \
                         zip_file_addon + key_list[2]
-                    download_start_time = time.time()
+                    tile_name = str(x) + "_" + str(y)
+                    if os.path.exists(final_path) or os.path.exists(tile_store_path(project_folder, key, tile_name)):
+                        continue
                     print(download_url_name)
-                    r = requests.get(download_url_name)
-                    zip_filepath = os.path.join(key_list[3], zip_file_name)
-
-                    if r.status_code == 200:
-                        print("File is successfully downloaded in", round(time.time() - download_start_time, 1),
-                              "seconds")
-                        with open(zip_filepath, 'wb') as f:
-                            f.write(r.content)
-
-                        if key_list[2].endswith('.zip'):
-                            with zipfile.ZipFile(zip_filepath, 'r') as zip_ref:
-                                zip_ref.extractall(key_list[3])
-                        if key_list[2].endswith('.gz'):
-                            with gzip.open(os.path.join(zip_filepath), 'rb') as f_in:
-                                with open(os.path.join(final_path), 'wb') as f_out:
-                                    shutil.copyfileobj(f_in, f_out)
-                        # check with Rato if this works
-                        if key_list[2].endswith('.laz'):
-                            cmdline = r'laszip.exe -i "{}" -otxt -oparse xyz'.format(
-                                filename.replace("//", "\\"))
-                            rc = call("start cmd /K " + cmdline,
-                                      cwd=dir_path, shell=True)
-
-                        for filename in os.listdir(folder):
-                            filename_path = os.path.join(folder, filename)
-                            if filename.endswith(file_appendix):
-                                os.rename(filename_path, final_path)
-                            else:
-                                os.remove(filename_path)
+                    downloader.submit(download_url_name, key, zip_file_name,
+                                      tile_processor(key_list[2], final_path, file_appendix, key, downloader,
+                                                     ingest_pool))
+    downloader.close()
+    ingest_pool.close()
+
+
+def tile_processor(appendix, final_path, file_appendix, key, downloader, ingest_pool):
+    """
+    Builds the function that unpacks a downloaded tile from the tile cache into final_path; it runs in the download
+    worker. Archives are extracted into a folder of their own, so tiles finishing at the same time do not pick up each
+    other's files. Point clouds are handed to the ingest pool and decoded into the tile store instead.
+    """
+    def process(zip_filepath):
+        if appendix.endswith('.zip'):
+            staging_folder = final_path + '.extract'
+            with zipfile.ZipFile(zip_filepath, 'r') as zip_ref:
+                zip_ref.extractall(staging_folder)
+            for root, _, file_names in os.walk(staging_folder):
+                for filename in file_names:
+                    if filename.endswith(file_appendix):
+                        os.replace(os.path.join(root, filename), final_path)
+            shutil.rmtree(staging_folder)
+        elif appendix.endswith('.gz'):
+            with gzip.open(zip_filepath, 'rb') as f_in:
+                with open(final_path, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+        elif appendix.endswith('.laz'):
+            ingest_pool.submit(zip_filepath, key, os.path.basename(final_path).split('.')[0], remove_source=False)
+        else:
+            downloader.tile_cache.materialise(zip_filepath, final_path)
+    return process
@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import numpy as np
+from polygon_from_kml import polygon_from_kml
+
+SIDECAR_SUFFIX = '_scene.npz'
+SCENE_FORMAT_VERSION = 1
+
+# abs kml path -> (scene key, scene dict)
+_SCENE_CACHE = {}
+
+
+def get_kml_file_path(project_folder):
+    """
+    Returns the path of the project KML file. The scene sidecar lives in the same folder, so it is skipped when
+    looking for the KML file.
+    :param project_folder: Directory where the project is stored.
+    :return kml_file_path: Path of the KML file of the project.
+    """
+    kml_folder = os.path.join(project_folder, 'GeospatialData', 'KML')
+    kml_files = [file_name for file_name in sorted(os.listdir(kml_folder))
+                 if not file_name.endswith(SIDECAR_SUFFIX)]
+    preferred = [file_name for file_name in kml_files if file_name.lower().endswith('.kml')]
+    if preferred:
+        kml_files = preferred
+    return os.path.join(kml_folder, kml_files[0])
+
+
+def category_d_hash(category_d):
+    """
+    Hashes the parsing dictionary, so that a change in category_d.json invalidates every cached scene.
+    :param category_d: Dictionary containing data necessary for parsing the KML files.
+    :return: sha1 hex digest of the canonical json dump of the dictionary.
+    """
+    canonical = json.dumps(category_d, sort_keys=True)
+    return hashlib.sha1(canonical.encode('utf8')).hexdigest()
+
+
+def scene_key(kml_file_path, category_d):
+    """
+    The key of a parsed scene: KML path, KML modification time and hash of the parsing dictionary.
+    """
+    kml_stat = os.stat(kml_file_path)
+    return "{}|{}|{}|{}".format(SCENE_FORMAT_VERSION, os.path.abspath(kml_file_path), kml_stat.st_mtime_ns,
+                                category_d_hash(category_d))
+
+
+def sidecar_path(kml_file_path):
+    return os.path.splitext(kml_file_path)[0] + SIDECAR_SUFFIX
+
+
+def scene_from_object_d(object_d):
+    """
+    Packs the result of polygon_from_kml into flat arrays: one point buffer with offsets per object, plus the object
+    types, IDs and centroids.
+    :param object_d: Dictionary returned by polygon_from_kml.
+    :return scene: Dictionary of numpy arrays describing the scene.
+    """
+    objects = object_d['objects']
+    counts = [len(i['shape']) if i['shape'] else 0 for i in objects]
+    offsets = np.zeros(len(objects) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    points = np.zeros((offsets[-1], 2), dtype=np.float64)
+    centroids = np.full((len(objects), 2), np.nan, dtype=np.float64)
+    for position, i in enumerate(objects):
+        if counts[position]:
+            points[offsets[position]:offsets[position + 1]] = i['shape']
+        if i['centroid'] is not None:
+            centroids[position] = i['centroid']
+
+    scene = {"types": np.array([str(i['TYPE']) for i in objects], dtype=str),
+             "ids": np.array(['' if i['ID'] is None else str(i['ID']) for i in objects], dtype=str),
+             "has_id": np.array([i['ID'] is not None for i in objects], dtype=bool),
+             "centroids": centroids,
+             "offsets": offsets,
+             "points": points}
+    return scene
+
+
+def object_d_from_scene(scene):
+    """
+    Rebuilds the polygon_from_kml structure from a scene. A fresh dictionary is returned on every call, so callers
+    can modify it without touching the cached scene.
+    :param scene: Dictionary of numpy arrays describing the scene.
+    :return object_d: A list of polygons in a dictionary for a given category.
+    """
+    object_d = {"objects": []}
+    offsets = scene['offsets']
+    for position in range(len(scene['types'])):
+        shape_a = scene['points'][offsets[position]:offsets[position + 1]].tolist()
+        centroid = scene['centroids'][position]
+        if np.isnan(centroid).any():
+            centroid = None
+        else:
+            centroid = tuple(centroid.tolist())
+        name = str(scene['ids'][position]) if scene['has_id'][position] else None
+        object_d["objects"].append({"shape": shape_a, "TYPE": str(scene['types'][position]),
+                                    "ID": name, "centroid": centroid})
+    return object_d
+
+
+def write_scene_sidecar(kml_file_path, key, scene):
+    # np.savez appends .npz itself, so write through an open file to keep the exact name
+    with open(sidecar_path(kml_file_path), 'wb') as f:
+        np.savez(f, key=np.array(key), **scene)
+
+
+def read_scene_sidecar(kml_file_path, key):
+    """
+    Loads the scene sidecar written next to the KML file. Returns None if there is no sidecar or if it was written
+    for a different KML version or parsing dictionary.
+    """
+    file_path = sidecar_path(kml_file_path)
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with np.load(file_path, allow_pickle=False) as sidecar:
+            if str(sidecar['key']) != key:
+                return None
+            scene = {name: sidecar[name] for name in sidecar.files if name != 'key'}
+    except (OSError, ValueError, KeyError):
+        print('scene sidecar could not be read, parsing the KML again.')
+        return None
+    return scene
+
+
+def load_kml_scene(kml_file_path, category_d):
+    """
+    Parse-once access to a project KML. The parsed scene is held in memory and in an .npz sidecar next to the KML
+    file. Both are keyed on the KML path, its modification time and the hash of category_d, so uploading a new KML
+    or changing the parsing dictionary triggers a new parse.
+    :param kml_file_path: Folder where the KML file for the project is stored.
+    :param category_d: Dictionary containing data necessary for parsing the KML files.
+    :return scene: Dictionary with the packed objects and centroids.
+    """
+    key = scene_key(kml_file_path, category_d)
+    cache_key = os.path.abspath(kml_file_path)
+    cached = _SCENE_CACHE.get(cache_key)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    scene = read_scene_sidecar(kml_file_path, key)
+    if scene is None:
+        scene = scene_from_object_d(polygon_from_kml(kml_file_path, category_d))
+        try:
+            write_scene_sidecar(kml_file_path, key, scene)
+        except OSError:
+            print('scene sidecar could not be written next to', kml_file_path)
+    _SCENE_CACHE[cache_key] = (key, scene)
+    return scene
+
+
+def cached_polygon_from_kml(kml_file_path, category_d):
+    """
+    Drop-in replacement of polygon_from_kml that goes through the scene cache.
+    """
+    return object_d_from_scene(load_kml_scene(kml_file_path, category_d))
@@ -2,11 +2,15 @@ import os
 import stl
 import numpy as np
 from shapely.geometry import Point, MultiPoint, Polygon
-from stl import mesh
 import random
 from read_json_files import read_json_files
 import utm
 from normalising_stl_files import building_utm_center
+from polygon_from_kml import polygon_from_kml
+from kml_scene_cache import cached_polygon_from_kml, get_kml_file_path
+from stl_reader import read_stl, closed_triangle_array
+from tile_store import open_layer
+from shapely_compat import contains_xy
 
 
 INPUT_FILES_FP = r'G:\Shared drives\07_Technology\07_technology\00_input_files'
@@ -45,14 +49,13 @@ def distance_max_from_class(points_shape, target_building_centroid):
     return maximum_distance
 
 
-def import_stl(mesh_file):
-    triangles_meshed = np.empty(len(mesh_file), dtype=object)
-    for position, data in enumerate(mesh_file.data):
-        data_new = data[1].tolist()
-        data_new.append(data[1][0].tolist())
-        data_new_a = np.array(data_new)
-        triangles_meshed[position] = data_new_a
-    return triangles_meshed
+def import_stl(stl_file_path):
+    """
+    Reads an STL file through the memory-mapped reader, without building a numpy-stl mesh.
+    :param stl_file_path: Path of the STL file.
+    :return: (n, 4, 3) float64 array of the closed triangles of the mesh.
+    """
+    return closed_triangle_array(read_stl(stl_file_path))
 
 
 def scale_triangles(triangles, width_scale, height_scale):
@@ -227,75 +230,57 @@ def point_in_polygon(center_point, polygon_a):
     return shp_polygon.contains(shp_point)
 
 
+def points_in_hull(tiles, hull_a, chunk_size=1000000):
+    """
+    Selects the points of tile store tiles that lie inside a hull. Only the tiles whose bounding box overlaps the hull
+    are read, and only the points in the bounding box of the hull are tested against the polygon.
+    :param tiles: PointTile objects of a layer.
+    :param hull_a: Polygon of the hull in the form [[x1,y1],[x2,y2],...].
+    :param chunk_size: Number of points processed at once.
+    :return: (n, 3) float64 array of the points inside the hull.
+    """
+    hull = np.asarray(hull_a, dtype=np.float64)[:, :2]
+    min_x, min_y = hull.min(axis=0)
+    max_x, max_y = hull.max(axis=0)
+    shp_polygon = Polygon(hull)
+    selected = []
+    for tile in tiles:
+        if not tile.bbox_intersects(min_x, min_y, max_x, max_y):
+            continue
+        origin_x, origin_y = tile.origin
+        for start in range(0, len(tile), chunk_size):
+            x_offset = tile.x_offset[start:start + chunk_size]
+            y_offset = tile.y_offset[start:start + chunk_size]
+            rows = np.nonzero((x_offset >= min_x - origin_x) & (x_offset <= max_x - origin_x) &
+                              (y_offset >= min_y - origin_y) & (y_offset <= max_y - origin_y))[0]
+            if len(rows) == 0:
+                continue
+            points = np.column_stack((x_offset[rows].astype(np.float64) + origin_x,
+                                      y_offset[rows].astype(np.float64) + origin_y,
+                                      tile.z[start:start + chunk_size][rows].astype(np.float64)))
+            inside = np.asarray(contains_xy(shp_polygon, points[:, 0], points[:, 1]), dtype=bool)
+            selected.append(points[inside])
+    return np.concatenate(selected) if selected else np.zeros((0, 3))
+
+
 def calculate_tree_height(project_folder, object_d_vegetation, tree_name):
+    """
+    Measures a tree from the DSM and DTM tile stores: the highest surface point and the lowest terrain point inside
+    the hull of the tree shape.
+    :return max_point_dsm, min_point_dtm, tree_height: Heights in metres, rounded to the centimetre.
+    """
     tree_shape = object_d_vegetation[tree_name]['shape']
     hull_target = hull_check(tree_shape)
-    dsm_file_path = os.path.join(project_folder, 'GeospatialData', 'DSM')
-    dtm_file_path = os.path.join(project_folder, 'GeospatialData', 'DTM')
-    dtm_file = None
-    dsm_file = None
-
-    tree_shape_utm_easting = []
-    tree_shape_utm_northing = []
-    for i in tree_shape:
-        if int(str(i[0])[:3]) % 2 == 0:
-            tree_shape_utm_easting.append(int(str(i[0])[:3]))
-        else:
-            tree_shape_utm_easting.append(int(str(i[0])[:3]))
 
-        if int(str(i[1])[:4]) % 2 == 0:
-            tree_shape_utm_northing.append(int(str(i[1])[:4]))
-        else:
-            tree_shape_utm_northing.append(int(str(i[1])[:4]) - 1)
-    needed_layers = [list(set(tree_shape_utm_easting)), list(set(tree_shape_utm_northing))]
-    print('needed layers', needed_layers)
-
-    coordinate_list_dsm = []
-    coordinate_list_dtm = []
-
-    point_list_dtm = []
-    point_list_dsm = []
-
-    x_unique = list(set([str(x[0])[:5] for x in hull_target]))
-    y_unique = list(set([str(x[1])[:5] for x in hull_target]))
-    for easting in needed_layers[0]:
-        for northing in needed_layers[1]:
-            file_name = str(easting) + "_" + str(northing)
-            dsm_files = [file.split('.')[0] for file in os.listdir(dtm_file_path)]
-            dsm_extension = list(set([file.split('.')[1] for file in os.listdir(dsm_file_path)]))
-            dtm_files = [file.split('.')[0] for file in os.listdir(dsm_file_path)]
-            dtm_extension = list(set([file.split('.')[1] for file in os.listdir(dtm_file_path)]))
-            if file_name in dsm_files:
-                dsm_file = open(os.path.join(dsm_file_path, f'{file_name}.{dsm_extension[0]}'), encoding='utf8')
-            if file_name in dtm_files:
-                dtm_file = open(os.path.join(dtm_file_path, f'{file_name}.{dtm_extension[0]}'), encoding='utf8')
-            print('dtm file', dtm_file)
-            for i in dtm_file:
-                unique_coordinate = list(map(float, i.split()))
-                if len(str(int(unique_coordinate[0]))) == 8:
-                    unique_coordinate[0] = float(str(unique_coordinate[0])[2:])
-                if str(unique_coordinate[0])[:5] in x_unique and str(unique_coordinate[1])[:5] in y_unique:
-                    coordinate_list_dtm.append(unique_coordinate)
-            for unique_coordinate in coordinate_list_dtm:
-                if point_in_polygon(unique_coordinate, hull_target):
-                    point_list_dtm.append(unique_coordinate)
-            print(str(len(point_list_dtm)), " belong in the dtm file.")
-            print(dsm_file)
-            for i in dsm_file:
-                unique_coordinate = list(map(float, i.split()))
-                if len(str(int(unique_coordinate[0]))) == 8:
-                    unique_coordinate[0] = float(str(unique_coordinate[0])[2:])
-                if str(unique_coordinate[0])[:5] in x_unique and str(unique_coordinate[1])[:5] in y_unique:
-                    coordinate_list_dsm.append(unique_coordinate)
-            for unique_coordinate in coordinate_list_dsm:
-                if point_in_polygon(unique_coordinate, hull_target):
-                    point_list_dsm.append(unique_coordinate)
-            print(str(len(point_list_dsm)), " belong in the dsm file.")
-
-            max_point_dsm = max([point[2] for point in point_list_dsm])
-            min_point_dtm = min([point[2] for point in point_list_dtm])
-            tree_height = round(max_point_dsm - min_point_dtm, 2)
-            return max_point_dsm, min_point_dtm, tree_height
+    point_list_dtm = points_in_hull(open_layer(project_folder, 'DTM'), hull_target)
+    print(str(len(point_list_dtm)), " belong in the dtm file.")
+    point_list_dsm = points_in_hull(open_layer(project_folder, 'DSM'), hull_target)
+    print(str(len(point_list_dsm)), " belong in the dsm file.")
+
+    max_point_dsm = round(float(point_list_dsm[:, 2].max()), 2)
+    min_point_dtm = round(float(point_list_dtm[:, 2].min()), 2)
+    tree_height = round(max_point_dsm - min_point_dtm, 2)
+    return max_point_dsm, min_point_dtm, tree_height
 
 
 def get_scales(triangle_array, diameter, height):
@@ -327,8 +312,7 @@ def random_tree_model_placement(building_center_point, project_folder, tree_name
                                        object_d_vegetation[tree_name]['centroid']) * 0.8 * 2
 
     random_tree = random.choice(os.listdir(TREES_FP))
-    triangles_tb_mesh = mesh.Mesh.from_file(os.path.join(TREES_FP, random_tree))
-    model_tree_a = import_stl(triangles_tb_mesh)
+    model_tree_a = import_stl(os.path.join(TREES_FP, random_tree))
 
     real_tree_center_point = list(object_d_vegetation[tree_name]['centroid'])
     real_tree_center_point.append(min_point_dtm)
@@ -351,8 +335,7 @@ def selected_tree_model_placement(building_center_point, project_folder, tree_na
                                        object_d_vegetation[tree_name]['centroid']) * 0.8 * 2
 
     selected_tree = os.path.join(INPUT_FILES_FP, 'tree_stl', f'{model_tree}.stl')
-    triangles_tb_mesh = mesh.Mesh.from_file(selected_tree)
-    model_tree_a = import_stl(triangles_tb_mesh)
+    model_tree_a = import_stl(selected_tree)
 
     real_tree_center_point = list(object_d_vegetation[tree_name]['centroid'])
     real_tree_center_point.append(min_point_dtm)
@@ -367,99 +350,10 @@ def selected_tree_model_placement(building_center_point, project_folder, tree_na
     print(f'{tree_name} done')
 
 
-def centroid_function(array):
-    """
-    Given a coordinate array [[x1, y1],...,[xn, yn]], this function finds the centroid point of the x and y coordinates.
-    :param array: The array we want to its center point.
-    :return round(sum_x / length, 2), round(sum_y / length, 2): The centroid point of the coordinate array.
-    """
-    length = array.shape[0]
-    try:
-        sum_x = np.sum(array[:, 0])
-        sum_y = np.sum(array[:, 1])
-        center_x = round(sum_x / length, 2)
-        center_y = round(sum_y / length, 2)
-        return center_x, center_y
-    except ZeroDivisionError:
-        print('empty array provided.')
-
-
-def polygon_from_kml(kml_file_path, category_d):
-    """
-    This function parses through a given KML file and creates polygons containing relevant data points. Additionally,
-    it converts the given lat long data into UTM coordinates.
-    :param kml_file_path: Folder where the KML file for the project is stored.
-    :param category_d: Dictionary containing data necessary for parsing the KML files.
-    :return object_d: A list of polygons in a dictionary for a given category.
-    """
-    object_d = {"objects": []}
-    kml_data = open(kml_file_path, "r")
-    polygon_found = False
-    layer_found = False
-    single_object_start = False
-    object_type = 'meh'
-    shape_a = None
-    name = None
-    centroid = None
-
-    for line in kml_data:
-        line = line.strip("\n")
-        line = line.strip("\t")
-        line = line.strip(" ")
-
-        if category_d['singleObject_end'] in line:
-            single_object_start = False
-
-        if single_object_start:
-            if category_d['ID_start'] in line:
-                line_6 = line[6:].split("<")
-                name = line_6[0]
-                # print(name)
-
-        if category_d['singleObject_start'] in line:
-            single_object_start = True
-
-        if category_d['category_end'] in line:
-            layer_found = False
-
-        if layer_found and single_object_start is False:
-            if category_d['ID_start'] in line:
-                line_b = line.split(">")
-                line_c = line_b[1].split("</")
-                object_type = line_c[0]
-                # print(type)
-        if category_d['category_start'] in line:
-            layer_found = True
-            # print(line)
-
-        if category_d["polygon_end"] in line:
-            polygon_found = False
-            polygon_d = {"shape": shape_a, "TYPE": object_type, "ID": name, "centroid": centroid}
-            object_d["objects"].append(polygon_d)
-        if polygon_found:
-            line_a = line.split(",")
-            line_a = line_a[:-1]
-            string_array = np.array(line_a)
-            float_array = string_array.astype(np.float)
-            utm_a = utm.from_latlon(float_array[1], float_array[0])
-            shape_a.append([round(utm_a[0], 2), round(utm_a[1], 2)])
-            points_array = np.array(shape_a)
-            centroid = centroid_function(points_array)
-
-        if category_d["polygon_start"] in line:
-            polygon_found = True
-            shape_a = []
-
-    return object_d
-
-
 def get_object_d_vegetation(project_file_path):
-    kml_folder = os.path.join(project_file_path, 'GeospatialData', 'KML')
-    kml_file_name = os.listdir(kml_folder)[0]
-
-    kml_fp = os.path.join(kml_folder, kml_file_name)
+    kml_fp = get_kml_file_path(project_file_path)
     category_d = read_json_files(CATEGORY_DICT)
-    json_dict = polygon_from_kml(kml_fp, category_d)
+    json_dict = cached_polygon_from_kml(kml_fp, category_d)
 
     object_d_vegetation = {}
     for i in json_dict['objects']:
@@ -1,13 +1,11 @@
 from stl_handling import import_stl, export_stl
-from stl import mesh
 import os
 import numpy as np
 import ast
 
 
 def building_utm_center(building_fp):
-    building_mesh = mesh.Mesh.from_file(building_fp)
-    building_mesh_a = import_stl(building_mesh)
+    building_mesh_a = import_stl(building_fp)
 
     x_coordinates_list = []
     y_coordinates_list = []
@@ -43,8 +41,7 @@ utm_center = building_utm_center(building_path)
 
 tp_path = os.path.join(project_folder, 'DigitalTwin', 'STLfiles', 'target_building_positioned2.stl')
 
-building_mesh = mesh.Mesh.from_file(tp_path)
-building_mesh_a = import_stl(building_mesh)
+building_mesh_a = import_stl(tp_path)
 
 building_center = building_utm_center(tp_path)
 
@@ -2,73 +2,89 @@ import numpy as np
 import utm
 
 
+def coordinates_to_utm(coordinate_lines):
+    """
+    Converts the content of one KML <coordinates> block into rounded UTM coordinates. All vertices are parsed into
+    one float array and converted with a single batched lat/lon to UTM call. The UTM zone of the first vertex is
+    used for the whole block, so a polygon is never split over two zones.
+    :param coordinate_lines: The text lines found between <coordinates> and </coordinates>.
+    :return shape_a: The polygon as an array of [easting, northing] pairs, rounded to 2 decimals.
+    """
+    tokens = " ".join(coordinate_lines).split()
+    if not tokens:
+        return np.zeros((0, 2))
+    try:
+        float_array = np.array(" ".join(tokens).replace(",", " ").split(), dtype=np.float64)
+        float_array = float_array.reshape(len(tokens), -1)
+    except ValueError:
+        # vertices with and without altitude mixed in one block
+        float_array = np.array([token.split(",")[:2] for token in tokens], dtype=np.float64)
+    longitude = float_array[:, 0]
+    latitude = float_array[:, 1]
+    zone_number = utm.latlon_to_zone_number(latitude[0], longitude[0])
+    easting, northing, _, _ = utm.from_latlon(latitude, longitude, force_zone_number=zone_number)
+    return np.round(np.column_stack((easting, northing)), 2)
+
+
 def polygon_from_kml(kml_file_path, category_d):
     """
     This function parses through a given KML file and creates polygons containing relevant data points. Additionally,
-    it converts the given lat long data into UTM coordinates.
+    it converts the given lat long data into UTM coordinates. The coordinates of a polygon are collected while
+    streaming through the file and converted at the end of the polygon, so parsing is linear in the vertex count.
     :param kml_file_path: Folder where the KML file for the project is stored.
     :param category_d: Dictionary containing data necessary for parsing the KML files.
     :return object_d: A list of polygons in a dictionary for a given category.
     """
     object_d = {"objects": []}
-    kml_data = open(kml_file_path, "r")
     polygon_found = False
     layer_found = False
     single_object_start = False
     object_type = 'meh'
-    shape_a = None
+    coordinate_lines = []
     name = None
-    centroid = None
 
-    for line in kml_data:
-        line = line.strip("\n")
-        line = line.strip("\t")
-        line = line.strip(" ")
+    with open(kml_file_path, "r") as kml_data:
+        for line in kml_data:
+            line = line.strip("\n")
+            line = line.strip("\t")
+            line = line.strip(" ")
 
-        if category_d['singleObject_end'] in line:
-            single_object_start = False
+            if category_d['singleObject_end'] in line:
+                single_object_start = False
 
-        if single_object_start:
-            if category_d['ID_start'] in line:
-                line_6 = line[6:].split("<")
-                name = line_6[0]
-                # print(name)
+            if single_object_start:
+                if category_d['ID_start'] in line:
+                    line_6 = line[6:].split("<")
+                    name = line_6[0]
 
-        if category_d['singleObject_start'] in line:
-            single_object_start = True
+            if category_d['singleObject_start'] in line:
+                single_object_start = True
 
-        if category_d['category_end'] in line:
-            layer_found = False
+            if category_d['category_end'] in line:
+                layer_found = False
 
-        if layer_found and single_object_start is False:
-            if category_d['ID_start'] in line:
-                line_b = line.split(">")
-                line_c = line_b[1].split("</")
-                object_type = line_c[0]
-        if category_d['category_start'] in line:
-            layer_found = True
-            # print(line)
+            if layer_found and single_object_start is False:
+                if category_d['ID_start'] in line:
+                    line_b = line.split(">")
+                    line_c = line_b[1].split("</")
+                    object_type = line_c[0]
+            if category_d['category_start'] in line:
+                layer_found = True
 
-        if category_d["polygon_end"] in line:
-            polygon_found = False
-            polygon_d = {"shape": shape_a, "TYPE": object_type, "ID": name, "centroid": centroid}
-            object_d["objects"].append(polygon_d)
-        if polygon_found:
-            #print(line)
-            line_a = line.split(",")
-            line_a = line_a[:-1]
-            string_array = np.array(line_a)
-            float_array = string_array.astype(np.float)
-            # print('LATITUDE LONGITUDE', float_array[1], float_array[0])
-            utm_a = utm.from_latlon(float_array[1], float_array[0])
-            # print('UTM', utm_a)
-            shape_a.append([round(utm_a[0], 2), round(utm_a[1], 2)])
-            points_array = np.array(shape_a)
-            centroid = centroid_function(points_array)
+            if category_d["polygon_start"] in line:
+                polygon_found = True
+                coordinate_lines = []
+                line = line.split(category_d["polygon_start"], 1)[1]
 
-        if category_d["polygon_start"] in line:
-            polygon_found = True
-            shape_a = []
+            if polygon_found:
+                polygon_end = category_d["polygon_end"] in line
+                coordinate_lines.append(line.split(category_d["polygon_end"], 1)[0])
+                if polygon_end:
+                    polygon_found = False
+                    shape_a = coordinates_to_utm(coordinate_lines)
+                    centroid = centroid_function(shape_a) if len(shape_a) else None
+                    polygon_d = {"shape": shape_a.tolist(), "TYPE": object_type, "ID": name, "centroid": centroid}
+                    object_d["objects"].append(polygon_d)
 
     return object_d
 
@@ -82,4 +98,4 @@ def centroid_function(array):
     length = array.shape[0]
     sum_x = np.sum(array[:, 0])
     sum_y = np.sum(array[:, 1])
-    return round(sum_x / length, 2), round(sum_y / length, 2)
\ No newline at end of file
+    return round(sum_x / length, 2), round(sum_y / length, 2)
@@ -0,0 +1,19 @@
+import requests
+from urllib3.exceptions import ConnectTimeoutError
+
+
+def request_not_sent(error):
+    """
+    Tells whether a request failed before it reached the server: the host name could not be resolved, the connection
+    was refused or connecting timed out. Only then can a POST be sent again without the risk of creating its item
+    twice; after a read timeout, a dropped connection or a 5xx response the server may have stored it already.
+    :param error: requests.exceptions.RequestException raised by the request.
+    :return: True if the request was not sent.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # requests wraps the urllib3 error in a MaxRetryError, the error itself is its reason
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, ConnectTimeoutError)
+    return False
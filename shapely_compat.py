@@ -0,0 +1,5 @@
+try:
+    from shapely import contains_xy
+except ImportError:
+    # Shapely 1.8: the vectorized predicate lives in shapely.vectorized
+    from shapely.vectorized import contains as contains_xy
@@ -1,6 +1,7 @@
 from stl import mesh
 import numpy as np
 import os
+from stl_reader import read_stl, closed_triangle_array
 
 
 def export_stl(project_folder, triangles_a, object_type):
@@ -30,14 +31,13 @@ def export_stl(project_folder, triangles_a, object_type):
     # todo use logging package instead of print("%s type exported to stl." % type)
 
 
-def import_stl(mesh_file):
-    triangles_meshed = np.empty(len(mesh_file), dtype=object)
-    for position, data in enumerate(mesh_file.data):
-        data_new = data[1].tolist()
-        data_new.append(data[1][0].tolist())
-        data_new_a = np.array(data_new)
-        triangles_meshed[position] = data_new_a
-    return triangles_meshed
+def import_stl(stl_file_path):
+    """
+    Reads an STL file through the memory-mapped reader, without building a numpy-stl mesh.
+    :param stl_file_path: Path of the STL file.
+    :return: (n, 4, 3) float64 array of the closed triangles of the mesh.
+    """
+    return closed_triangle_array(read_stl(stl_file_path))
 
 """
 project_folder = r"G:\Shared drives\04_Sales_and_Operations\03_Operations\Twin_Hatten\Stadtwerke-Buchholz"
@@ -46,8 +46,7 @@ tree_mesh_list = []
 for stl_file in os.listdir(stl_folder):
     # if 'building' in stl_file:
     print(stl_file)
-    tree_mesh = mesh.Mesh.from_file(os.path.join(stl_folder, stl_file))
-    tree_mesh_a = import_stl(tree_mesh)
+    tree_mesh_a = import_stl(os.path.join(stl_folder, stl_file))
     tree_mesh_list.append(tree_mesh_a)
 
 all_trees = np.concatenate(tree_mesh_list)
@@ -57,8 +56,7 @@ building_list = []
 for stl_file in os.listdir(stl_folder):
     if 'building' in stl_file:
         print(stl_file)
-        building_mesh = mesh.Mesh.from_file(os.path.join(stl_folder, stl_file))
-        building_mesh_a = import_stl(building_mesh)
+        building_mesh_a = import_stl(os.path.join(stl_folder, stl_file))
         building_list.append(building_mesh_a)
 
 all_buildings = np.concatenate(building_list)
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+from stl_writer import STL_HEADER_SIZE, STL_RECORD_DTYPE, BinaryStlWriter, triangle_records
+
+STL_DATA_OFFSET = STL_HEADER_SIZE + 4
+
+
+class StlReadError(Exception):
+    pass
+
+
+def binary_triangle_count(file_path):
+    """
+    :return: The triangle count of a binary STL file, None if the file is not a binary STL (its size does not match
+    the count in the header).
+    """
+    size = os.path.getsize(file_path)
+    if size < STL_DATA_OFFSET:
+        return None
+    count = int(np.fromfile(file_path, dtype='<u4', count=1, offset=STL_HEADER_SIZE)[0])
+    if size != STL_DATA_OFFSET + count * STL_RECORD_DTYPE.itemsize:
+        return None
+    return count
+
+
+def read_ascii_stl(file_path):
+    """
+    Reads the vertices of an ASCII STL file.
+    :return: (n, 3, 3) float32 array of the triangles.
+    """
+    with open(file_path, 'r', encoding='ascii', errors='replace') as f:
+        vertex_lines = [line.split()[1:4] for line in f if line.lstrip().startswith('vertex')]
+    if len(vertex_lines) % 3:
+        raise StlReadError('%s has %s vertices, which is not a multiple of 3.' % (file_path, len(vertex_lines)))
+    return np.array(vertex_lines, dtype=np.float32).reshape(-1, 3, 3)
+
+
+def read_stl_records(file_path):
+    """
+    Opens the triangle records of an STL file. Binary files are memory-mapped, nothing is read before it is used;
+    ASCII files are parsed and packed into records.
+    :return: Structured array of STL_RECORD_DTYPE.
+    """
+    count = binary_triangle_count(file_path)
+    if count == 0:
+        return np.zeros(0, dtype=STL_RECORD_DTYPE)
+    if count is not None:
+        return np.memmap(file_path, dtype=STL_RECORD_DTYPE, mode='r', offset=STL_DATA_OFFSET, shape=(count,))
+    with open(file_path, 'rb') as f:
+        if not f.read(5).lower().startswith(b'solid'):
+            raise StlReadError('%s is neither a binary nor an ASCII STL file.' % file_path)
+    return triangle_records(read_ascii_stl(file_path))
+
+
+def read_stl(file_path):
+    """
+    :return: (n, 3, 3) float32 array of the triangles of an STL file; a read-only memory-mapped view for binary files.
+    """
+    return read_stl_records(file_path)['vectors']
+
+
+def closed_triangle_array(vectors):
+    """
+    Turns (n, 3, 3) triangle vertices into the closed (n, 4, 3) float64 triangles used by import_stl, where the
+    first vertex is repeated at the end.
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    return np.concatenate((vectors, vectors[:, :1]), axis=1)
+
+
+def merge_stl_files(file_paths, output_path):
+    """
+    Concatenates STL files into one binary STL file. The records of binary files are copied as they are, without
+    converting the vertices, so merging is bound by the disk.
+    :param file_paths: Paths of the STL files to merge, in the order they are written.
+    :param output_path: Path of the merged STL file.
+    :return: The number of triangles written.
+    """
+    with BinaryStlWriter(output_path) as merged_stl:
+        for file_path in file_paths:
+            merged_stl.write_records(read_stl_records(file_path))
+    return merged_stl.count
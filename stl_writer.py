@@ -0,0 +1,107 @@
+import os
+import numpy as np
+
+STL_HEADER_SIZE = 80
+# one binary STL triangle: normal, three vertices and the attribute byte count, 50 bytes without padding
+STL_RECORD_DTYPE = np.dtype([('normals', '<f4', (3,)),
+                             ('vectors', '<f4', (3, 3)),
+                             ('attr', '<u2')])
+DEFAULT_CHUNK_SIZE = 1000000
+
+
+def triangle_records(triangles):
+    """
+    Packs triangles into binary STL records. The normals are the cross products of the first two edges, not scaled
+    to unit length, computed on the float32 vertices like numpy-stl does, so the files match the ones numpy-stl
+    writes.
+    :param triangles: Array of shape (n, 3, 3), or (n, 4, 3) closed triangles.
+    :return records: Structured array of STL_RECORD_DTYPE.
+    """
+    triangles = np.asarray(triangles)
+    records = np.zeros(len(triangles), dtype=STL_RECORD_DTYPE)
+    if len(triangles):
+        records['vectors'] = triangles[:, :3]
+        vectors = records['vectors']
+        records['normals'] = np.cross(vectors[:, 1] - vectors[:, 0], vectors[:, 2] - vectors[:, 0])
+    return records
+
+
+class BinaryStlWriter:
+    """
+    Writes a binary STL file chunk by chunk, so a mesh never has to be held in memory as a whole. The triangle count
+    in the header is written when the file is closed. The file is written next to its final location and renamed
+    on close, so a failed export never leaves a truncated STL behind.
+
+    with BinaryStlWriter(file_path) as stl_file:
+        for chunk in chunks:
+            stl_file.write(chunk)
+    """
+
+    def __init__(self, file_path, header=b'gui_leaftech binary STL'):
+        self.file_path = file_path
+        self.temp_path = file_path + '.part'
+        self.count = 0
+        self.file = open(self.temp_path, 'wb')
+        self.file.write(header[:STL_HEADER_SIZE].ljust(STL_HEADER_SIZE, b' '))
+        self.file.write(np.uint32(0).tobytes())
+
+    def write(self, triangles):
+        """
+        :param triangles: Array of shape (n, 3, 3), or (n, 4, 3) closed triangles.
+        """
+        self.write_records(triangle_records(triangles))
+
+    def write_records(self, records):
+        """
+        Appends records built with triangle_records; lets one chunk be packed once and written to several files.
+        """
+        records.tofile(self.file)
+        self.count += len(records)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.seek(STL_HEADER_SIZE)
+        self.file.write(np.uint32(self.count).tobytes())
+        self.file.close()
+        os.replace(self.temp_path, self.file_path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def triangle_chunks(triangle_a, chunk_size=DEFAULT_CHUNK_SIZE, origin=None):
+    """
+    Cuts a triangle array into chunks. With an origin, every chunk is a copy moved to that origin and rounded to
+    the millimetre, like triangle_norming, and the input array is left as it is.
+    :param triangle_a: Array of shape (n, 3, 3).
+    :param chunk_size: Number of triangles per chunk.
+    :param origin: Optional [x, y, z] point that becomes the origin.
+    :return: Generator of (m, 3, 3) arrays.
+    """
+    for start in range(0, len(triangle_a), chunk_size):
+        chunk = triangle_a[start:start + chunk_size]
+        if origin is not None:
+            chunk = np.round(chunk - np.asarray(origin, dtype=np.float64), 3)
+        yield chunk
+
+
+def write_stl(file_path, chunks):
+    """
+    Writes an iterable of triangle chunks into one binary STL file.
+    :return: The number of triangles written.
+    """
+    with BinaryStlWriter(file_path) as stl_file:
+        for chunk in chunks:
+            stl_file.write(chunk)
+    return stl_file.count
@@ -0,0 +1,126 @@
+import ast
+import json
+import zlib
+import base64
+import numpy as np
+
+SURFACE_CODEC = 'leaftech-surfaces'
+SURFACE_CODEC_VERSION = 1
+# coordinates are stored as integer offsets to the origin in 1 / COORDINATE_SCALE metres (millimetres)
+COORDINATE_SCALE = 1000
+# set to True to upload the data fields in the old python repr format, for readers that do not know the codec yet
+WRITE_LEGACY_REPR = False
+
+
+class SurfaceCodecError(Exception):
+    pass
+
+
+def _pack(array):
+    return base64.b64encode(zlib.compress(np.ascontiguousarray(array).tobytes(), 6)).decode('ascii')
+
+
+def _unpack(text, dtype):
+    return np.frombuffer(zlib.decompress(base64.b64decode(text)), dtype=dtype)
+
+
+def encode_surfaces(surfaces):
+    """
+    Encodes a list of surface dictionaries ({"polygon": [[x, y, z], ...], ...}) for the data field of building and
+    terrain objects. All vertices are packed into one little endian int32 buffer of millimetre offsets to an origin,
+    with the vertex count of every surface next to it (both zlib compressed and base64 encoded); the other keys of the
+    surfaces are kept as json.
+
+    The offsets are integers on purpose: float32 only has about 7 significant digits and can not hold UTM northings
+    (7 digits before the decimal point) to the centimetre.
+    :param surfaces: List of surface dictionaries with a polygon of equally long vertices.
+    :return: The encoded surfaces as a json string, or their python repr if WRITE_LEGACY_REPR is set or the
+    coordinates do not fit the offsets.
+    """
+    if WRITE_LEGACY_REPR:
+        return str(surfaces)
+    counts = np.array([len(surface['polygon']) for surface in surfaces], dtype=np.int64)
+    vertices = [vertex for surface in surfaces for vertex in surface['polygon']]
+    dimension = len(vertices[0]) if vertices else 3
+    points = np.array(vertices, dtype=np.float64).reshape(-1, dimension)
+    # terrain polygons have integer coordinates, they are decoded as integers again
+    integer = bool(vertices) and all(isinstance(value, (int, np.integer)) for value in vertices[0])
+
+    origin = np.floor(points.min(axis=0)) if len(points) else np.zeros(dimension)
+    offsets = np.round((points - origin) * COORDINATE_SCALE)
+    if len(offsets) and offsets.max() > np.iinfo(np.int32).max:
+        # only broken coordinates span more than 2000 km; they are kept readable in the legacy format
+        print('surfaces span more than %s m, writing them in the legacy format.'
+              % (np.iinfo(np.int32).max // COORDINATE_SCALE))
+        return str(surfaces)
+
+    metadata = [{key: value for key, value in surface.items() if key != 'polygon'} for surface in surfaces]
+    encoded = {"codec": SURFACE_CODEC,
+               "version": SURFACE_CODEC_VERSION,
+               "dimension": dimension,
+               "scale": COORDINATE_SCALE,
+               "integer": integer,
+               "origin": origin.tolist(),
+               "counts": _pack(counts.astype('<u4')),
+               "points": _pack(offsets.astype('<i4')),
+               "surfaces": metadata}
+    return json.dumps(encoded, separators=(',', ':'))
+
+
+def is_encoded(data):
+    return data.lstrip().startswith('{"codec"')
+
+
+def decode_surface_arrays(data):
+    """
+    Decodes a data field into arrays, without building a list per vertex.
+    :param data: The data field of a building or terrain object, encoded or in the legacy python repr format.
+    :return points, offsets, metadata: (n, dimension) float64 array of all vertices, int64 array with the start of
+    every surface in points (plus the end), and the list of the other keys of the surfaces.
+    """
+    if not is_encoded(data):
+        surfaces = ast.literal_eval(data)
+        counts = [len(surface['polygon']) for surface in surfaces]
+        offsets = np.zeros(len(surfaces) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        vertices = [vertex for surface in surfaces for vertex in surface['polygon']]
+        points = np.array(vertices, dtype=np.float64).reshape(len(vertices), -1) if vertices else np.zeros((0, 3))
+        metadata = [{key: value for key, value in surface.items() if key != 'polygon'} for surface in surfaces]
+        return points, offsets, metadata
+
+    return _arrays_from_encoded(json.loads(data))
+
+
+def _arrays_from_encoded(encoded):
+    if encoded.get("codec") != SURFACE_CODEC or encoded.get("version") != SURFACE_CODEC_VERSION:
+        raise SurfaceCodecError('unknown surface codec %s version %s.' % (encoded.get("codec"),
+                                                                         encoded.get("version")))
+    counts = _unpack(encoded["counts"], '<u4').astype(np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    points = _unpack(encoded["points"], '<i4').reshape(-1, encoded["dimension"]) / encoded["scale"]
+    points += np.array(encoded["origin"], dtype=np.float64)
+    return points, offsets, encoded["surfaces"]
+
+
+def decode_surfaces(data):
+    """
+    Decodes a data field into the list of surface dictionaries it was encoded from. Payloads written before the codec
+    existed (python repr) are read with ast.literal_eval.
+    :param data: The data field of a building or terrain object.
+    :return surfaces: List of surface dictionaries with the polygon as a list of vertex lists.
+    """
+    if not is_encoded(data):
+        return ast.literal_eval(data)
+    encoded = json.loads(data)
+    points, offsets, metadata = _arrays_from_encoded(encoded)
+    if encoded["integer"]:
+        points = np.round(points).astype(np.int64)
+    else:
+        points = np.round(points, 3)
+    surfaces = []
+    for position, surface_metadata in enumerate(metadata):
+        surface = {"polygon": points[offsets[position]:offsets[position + 1]].tolist()}
+        surface.update(surface_metadata)
+        surfaces.append(surface)
+    return surfaces
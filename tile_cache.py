@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import hashlib
+import shutil
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# root of the machine-wide cache; the default keeps it on the volume of the projects, so tiles can be hard-linked
+TILE_CACHE_ENV = 'LEAFTECH_TILE_CACHE'
+# size budget of the cache in GB
+TILE_CACHE_BUDGET_ENV = 'LEAFTECH_TILE_CACHE_BUDGET'
+DEFAULT_CACHE_BUDGET = 50 * 1024 ** 3
+ENTRY_EXTENSION = '.entry.json'
+LOCK_EXTENSION = '.lock'
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+# (path, size, sha256) of the cached tiles whose checksum was verified in this process
+_VERIFIED = set()
+_VERIFIED_LOCK = threading.Lock()
+
+
+def file_sha256(file_path, chunk_size=CHECKSUM_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def default_cache_root():
+    return os.environ.get(TILE_CACHE_ENV) or os.path.join(os.getcwd(), 'tile_cache')
+
+
+def default_cache_budget():
+    budget = os.environ.get(TILE_CACHE_BUDGET_ENV)
+    return int(float(budget) * 1024 ** 3) if budget else DEFAULT_CACHE_BUDGET
+
+
+class EntryLock:
+    """
+    Exclusive lock on one cache entry, held through an OS lock on <file path>.lock. It works between the threads of a
+    process and between processes, e.g. two projects downloading the same tile, and is released by the OS if the
+    process dies. Evicting a tile removes its lock file while holding the lock, so a lock taken on a file that was
+    removed in the meantime is given up and taken again on the new file.
+
+    with EntryLock(file_path):
+        ...
+    """
+
+    def __init__(self, file_path):
+        self.lock_path = file_path + LOCK_EXTENSION
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """
+        :param blocking: Wait until the lock is free, otherwise give up at once if another holder has it.
+        :return: True if the lock was taken.
+        """
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        while True:
+            lock_file = open(self.lock_path, 'a+b')
+            if not self._lock_file(lock_file, blocking):
+                lock_file.close()
+                return False
+            try:
+                current = os.stat(self.lock_path)
+            except FileNotFoundError:
+                current = None
+            if current is not None and os.path.samestat(current, os.fstat(lock_file.fileno())):
+                self._file = lock_file
+                return True
+            # the lock file was removed by an eviction while we waited for it
+            self._unlock_file(lock_file)
+            lock_file.close()
+
+    @staticmethod
+    def _lock_file(lock_file, blocking):
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            return True
+        lock_file.seek(0)
+        while True:
+            try:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                # LK_LOCK gives up after 10 seconds
+                time.sleep(1)
+
+    @staticmethod
+    def _unlock_file(lock_file):
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def release(self):
+        try:
+            self._unlock_file(self._file)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class TileCache:
+    """
+    Machine-wide cache of geodata tiles shared by all projects, stored as <root>/<county>/<layer>/<file name>. Next to
+    every tile its manifest entry is kept (<file name>.entry.json) with its size and sha256; the checksum of a tile is
+    verified the first time the tile is used in a process, and tiles that do not match are dropped. Projects get hard
+    links to the cached tiles, or copies where the file system does not support links, so neighbouring projects reuse
+    tiles without fetching them again. When the cache grows over its budget, the least recently used tiles are
+    evicted; the modification time of a tile is its last use. Tiles are written under the lock of their entry, so
+    projects downloading the same tile at the same time do not write into the same files. The size of the cache is
+    counted when the first tile is added and then kept up to date by add, so the folder is only walked again when
+    tiles have to be evicted. shared_tile_cache gives one instance per cache folder and process, so downloaders
+    share the running size instead of counting the cache again.
+
+    tile_cache = shared_tile_cache()
+    file_path, entry = tile_cache.get('NRW', 'GML', file_name)
+    tile_cache.materialise(file_path, project_file_path)
+    """
+
+    def __init__(self, root=None, budget=None):
+        """
+        :param root: Folder of the cache, LEAFTECH_TILE_CACHE or ./tile_cache by default.
+        :param budget: Size budget in bytes, LEAFTECH_TILE_CACHE_BUDGET (GB) or 50 GB by default.
+        """
+        self.root = root or default_cache_root()
+        self.budget = default_cache_budget() if budget is None else budget
+        self._lock = threading.Lock()
+        # cache path -> size of the tiles this instance knows of, and their total; None until the cache is counted
+        self._sizes = None
+        self.size = None
+
+    def path(self, county, layer, file_name):
+        return os.path.join(self.root, county, layer, file_name)
+
+    def lock(self, county, layer, file_name):
+        """
+        :return: EntryLock of a tile, to be held while the tile is looked up and written.
+        """
+        return EntryLock(self.path(county, layer, file_name))
+
+    @staticmethod
+    def read_entry(file_path):
+        try:
+            with open(file_path + ENTRY_EXTENSION, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, county, layer, file_name):
+        """
+        Looks a tile up and marks it as recently used. A tile whose size or checksum does not match its entry, or
+        whose entry has no checksum, is removed and counts as not cached.
+        :return file_path, entry: Path and manifest entry of the cached tile, None, None if it is not cached.
+        """
+        file_path = self.path(county, layer, file_name)
+        entry = self.read_entry(file_path)
+        if entry is None or not os.path.exists(file_path):
+            return None, None
+        if os.path.getsize(file_path) != entry.get('size') or not self.verify(file_path, entry):
+            print(file_path, 'does not match its entry, removing it from the tile cache.')
+            self.remove(file_path)
+            return None, None
+        os.utime(file_path)
+        return file_path, entry
+
+    @staticmethod
+    def verify(file_path, entry):
+        """
+        Compares the sha256 of a cached tile with its entry, once per process and tile.
+        :return: True if the checksum matches.
+        """
+        if not entry.get('sha256'):
+            return False
+        key = (file_path, entry['size'], entry['sha256'])
+        with _VERIFIED_LOCK:
+            if key in _VERIFIED:
+                return True
+        if file_sha256(file_path) != entry['sha256']:
+            return False
+        with _VERIFIED_LOCK:
+            _VERIFIED.add(key)
+        return True
+
+    def remove(self, file_path):
+        with self._lock:
+            self._remove_tile(file_path)
+
+    def _remove_tile(self, file_path, lock_file=False):
+        """
+        Deletes a tile and its entry. Called with the lock held.
+        :param lock_file: Also delete the lock file of the entry, only while holding the entry lock and not writing the
+        tile again.
+        """
+        paths = (file_path, file_path + ENTRY_EXTENSION) + ((file_path + LOCK_EXTENSION,) if lock_file else ())
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                # Windows does not remove a lock file another process has open, it is removed with a later eviction
+                if path == file_path:
+                    raise
+        if self._sizes is not None:
+            self.size -= self._sizes.pop(file_path, 0)
+
+    def add(self, file_path, entry):
+        """
+        Records a tile that was written to its cache path, then evicts tiles if it pushed the cache over its budget.
+        The sha256 in the entry is computed from the written file, so the tile counts as verified in this process.
+        """
+        temp_path = file_path + ENTRY_EXTENSION + '.part'
+        with open(temp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temp_path, file_path + ENTRY_EXTENSION)
+        tile_size = os.path.getsize(file_path)
+        if entry.get('sha256') and entry.get('size') == tile_size:
+            with _VERIFIED_LOCK:
+                _VERIFIED.add((file_path, tile_size, entry['sha256']))
+        with self._lock:
+            if self._sizes is None:
+                self._count_tiles()
+            self.size += tile_size - self._sizes.get(file_path, 0)
+            self._sizes[file_path] = tile_size
+            over_budget = self.size > self.budget
+        if over_budget:
+            self.evict()
+
+    def put_file(self, source_path, county, layer, file_name=None):
+        """
+        Copies a file, e.g. from a shared drive, into the cache unless it is cached already.
+        :return file_path: Path of the cached tile.
+        """
+        file_name = file_name or os.path.basename(source_path)
+        with self.lock(county, layer, file_name):
+            file_path, entry = self.get(county, layer, file_name)
+            if file_path is not None:
+                return file_path
+            file_path = self.path(county, layer, file_name)
+            shutil.copyfile(source_path, file_path + '.part')
+            os.replace(file_path + '.part', file_path)
+            self.add(file_path, {"source": source_path, "size": os.path.getsize(file_path),
+                                 "sha256": file_sha256(file_path)})
+        return file_path
+
+    @staticmethod
+    def materialise(file_path, destination_path):
+        """
+        Puts a cached tile into a project folder as a hard link, or as a copy if linking fails (other volume, file
+        system without links). The project file must be treated as read-only, it may be the cached file itself.
+        """
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        if os.path.exists(destination_path):
+            if os.path.samefile(file_path, destination_path):
+                return destination_path
+            os.remove(destination_path)
+        try:
+            os.link(file_path, destination_path)
+        except OSError:
+            shutil.copy2(file_path, destination_path)
+        return destination_path
+
+    def _count_tiles(self):
+        """
+        Walks the cache folder and resets the running size to the tiles found, which includes the tiles added by other
+        processes. Called with the lock held.
+        :return: List of (modification time, size, path) of the tiles.
+        """
+        tiles = []
+        for folder, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith((ENTRY_EXTENSION, LOCK_EXTENSION, '.part')):
+                    continue
+                file_path = os.path.join(folder, file_name)
+                try:
+                    status = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                tiles.append((status.st_mtime, status.st_size, file_path))
+        self._sizes = {file_path: tile_size for _, tile_size, file_path in tiles}
+        self.size = sum(self._sizes.values())
+        return tiles
+
+    def evict(self):
+        """
+        Removes the least recently used tiles until the cache fits its budget. Tiles whose entry lock is held, e.g.
+        by a project reading or writing them, are skipped.
+        :return: The number of bytes freed.
+        """
+        with self._lock:
+            tiles = self._count_tiles()
+            freed = 0
+            for _, tile_size, file_path in sorted(tiles):
+                if self.size <= self.budget:
+                    break
+                entry_lock = EntryLock(file_path)
+                if not entry_lock.acquire(blocking=False):
+                    continue
+                try:
+                    self._remove_tile(file_path, lock_file=True)
+                finally:
+                    entry_lock.release()
+                freed += tile_size
+                print('evicted', file_path, 'from the tile cache.')
+            return freed
+
+
+# (root, budget) -> TileCache shared by the downloaders of this process
+_SHARED_CACHES = {}
+_SHARED_CACHES_LOCK = threading.Lock()
+
+
+def shared_tile_cache(root=None, budget=None):
+    """
+    :return: The TileCache of a cache folder for this process, created on the first call. The arguments default as in
+    TileCache.
+    """
+    root = root or default_cache_root()
+    budget = default_cache_budget() if budget is None else budget
+    with _SHARED_CACHES_LOCK:
+        key = (os.path.abspath(root), budget)
+        if key not in _SHARED_CACHES:
+            _SHARED_CACHES[key] = TileCache(root, budget)
+        return _SHARED_CACHES[key]
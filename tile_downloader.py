@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from tile_cache import shared_tile_cache, file_sha256
+
+MANIFEST_NAME = 'download_manifest.json'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# (connect, read) timeout in seconds
+DOWNLOAD_TIMEOUT = (15, 120)
+
+
+def manifest_path(project_folder):
+    return os.path.join(project_folder, 'GeospatialData', MANIFEST_NAME)
+
+
+def content_range_start(response):
+    """
+    :return: First byte position of the Content-Range header of a 206 response ('bytes 1000-1999/2000' -> 1000), None
+    if the header is missing or cannot be read.
+    """
+    content_range = response.headers.get('Content-Range', '')
+    unit, _, byte_range = content_range.strip().partition(' ')
+    start = byte_range.split('-', 1)[0]
+    if unit.lower() != 'bytes' or not start.isdigit():
+        return None
+    return int(start)
+
+
+def download_file(session, url, file_path, retries=3, backoff=2.0):
+    """
+    Streams a url into file_path. The body is written in chunks to file_path + '.part', which is renamed once the
+    download is complete. A .part file left by an interrupted download is resumed with an HTTP Range request; if the
+    server does not support ranges, or answers with a range that does not start at the end of the .part file, the
+    download starts over.
+    :param session: requests.Session used for the download.
+    :param url: Url of the file.
+    :param file_path: Final path of the file.
+    :param retries: Number of retries after connection errors.
+    :param backoff: Seconds to wait before the first retry, doubled for every further retry.
+    :return entry: Dictionary with url, status_code, and for complete downloads size and sha256.
+    """
+    temp_path = file_path + '.part'
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        resume_from = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+        headers = {'Range': 'bytes=%d-' % resume_from} if resume_from else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 416:
+                    # the .part file does not fit the file on the server any more
+                    os.remove(temp_path)
+                    continue
+                if response.status_code not in (200, 206):
+                    return {"url": url, "status_code": response.status_code}
+                if response.status_code == 200:
+                    resume_from = 0
+                elif content_range_start(response) != resume_from:
+                    print('download of', url, 'answered with range', response.headers.get('Content-Range'),
+                          'instead of bytes', resume_from, 'onwards, starting over.')
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    continue
+                with open(temp_path, 'ab' if resume_from else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+        except requests.exceptions.RequestException as error:
+            print('download of', url, 'interrupted:', error)
+            continue
+        os.replace(temp_path, file_path)
+        return {"url": url, "status_code": 200, "size": os.path.getsize(file_path),
+                "sha256": file_sha256(file_path)}
+    return {"url": url, "status_code": None}
+
+
+class ResponseReader:
+    """
+    Read-only file object over the body of a streamed response, so a tile can be decompressed while it is downloaded.
+    Keeps the size and sha256 of everything read for the manifest, and optionally copies the body into a file.
+    """
+
+    def __init__(self, response, chunk_size=DOWNLOAD_CHUNK_SIZE, tee=None):
+        self._chunks = response.iter_content(chunk_size=chunk_size)
+        self._buffer = bytearray()
+        self._tee = tee
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self.size += len(chunk)
+            self.sha256.update(chunk)
+            if self._tee is not None:
+                self._tee.write(chunk)
+            self._buffer += chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def stream_file(session, url, consume, tee_path=None, retries=3, backoff=2.0):
+    """
+    Streams a url into a consumer. After a connection error the consumer is called again with a new stream from the
+    start, so it has to write its output atomically.
+    :param session: requests.Session used for the download.
+    :param url: Url of the file.
+    :param consume: Function (file object) reading the body.
+    :param tee_path: Optional path the body is written to while it is consumed.
+    :return entry: Dictionary with url, status_code, and for complete downloads size and sha256.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 200:
+                    return {"url": url, "status_code": response.status_code}
+                tee = open(tee_path, 'wb') if tee_path else None
+                try:
+                    reader = ResponseReader(response, tee=tee)
+                    consume(reader)
+                    # read what the consumer left, the checksum covers the whole file
+                    while reader.read(DOWNLOAD_CHUNK_SIZE):
+                        pass
+                finally:
+                    if tee is not None:
+                        tee.close()
+        except requests.exceptions.RequestException as error:
+            print('download of', url, 'interrupted:', error)
+            continue
+        return {"url": url, "status_code": 200, "size": reader.size, "sha256": reader.sha256.hexdigest()}
+    return {"url": url, "status_code": None}
+
+
+class TileDownloader:
+    """
+    Downloads geodata tiles into the machine-wide tile cache with a bounded pool of worker threads over one pooled
+    session. Tiles already in the cache, e.g. fetched by a neighbouring project, are not downloaded again. Every tile a
+    project uses is recorded in its manifest (GeospatialData/download_manifest.json) with its size and sha256. An
+    optional callback is run in the worker as soon as its tile is available, so extracting or converting a tile
+    overlaps with the remaining downloads; it gets the path of the cached file, which it must not change or remove.
+
+    Tiles can also be streamed into a consumer with submit_stream, which decodes them while they are downloaded.
+
+    downloader = TileDownloader(project_folder, county)
+    downloader.submit(url, layer, file_name, on_complete)
+    downloader.submit_stream(url, layer, file_name, consume)
+    downloader.close()
+    """
+
+    def __init__(self, project_folder, county, workers=4, tile_cache=None):
+        """
+        :param project_folder: Directory where the project is stored.
+        :param county: County of the project, part of the cache key of its tiles.
+        :param workers: Number of concurrent downloads.
+        :param tile_cache: TileCache the tiles are stored in, the shared default cache of the process if None.
+        """
+        self.project_folder = project_folder
+        self.county = county
+        self.tile_cache = tile_cache or shared_tile_cache()
+        self.manifest_path = manifest_path(project_folder)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    self.manifest = json.load(f)
+            except ValueError:
+                print('download manifest could not be read, starting a new one.')
+        self._manifest_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+
+    def submit(self, url, layer, file_name, on_complete=None):
+        """
+        Queues the download of url into the cache as <county>/<layer>/<file_name>.
+        :param on_complete: Optional function (file path) called in the worker once the file is available.
+        :return: Future of the manifest entry of the tile.
+        """
+        future = self._executor.submit(self._download, url, layer, file_name, on_complete)
+        self._futures.append(future)
+        return future
+
+    def submit_stream(self, url, layer, file_name, consume):
+        """
+        Queues the download of url into consume. The body is written to the cache while it is consumed; a tile that
+        is cached already is consumed from the cache.
+        :param consume: Function (file object) called in the worker with the body of the tile.
+        :return: Future of the manifest entry of the tile.
+        """
+        future = self._executor.submit(self._stream, url, layer, file_name, consume)
+        self._futures.append(future)
+        return future
+
+    def _stream(self, url, layer, file_name, consume):
+        # a project streaming the same tile holds the lock until the tile is cached, then it is read from the cache
+        with self.tile_cache.lock(self.county, layer, file_name):
+            file_path, entry = self.tile_cache.get(self.county, layer, file_name)
+            if file_path is not None:
+                with open(file_path, 'rb') as f:
+                    consume(f)
+            else:
+                file_path = self.tile_cache.path(self.county, layer, file_name)
+                start_time = time.time()
+                entry = stream_file(self.session, url, consume, tee_path=file_path + '.part')
+                print('url:', url, 'status code:', entry['status_code'], 'in', round(time.time() - start_time, 1),
+                      's')
+                if entry['status_code'] != 200:
+                    return entry
+                os.replace(file_path + '.part', file_path)
+                self.tile_cache.add(file_path, entry)
+        self.record(layer + '/' + file_name, entry)
+        return entry
+
+    def _download(self, url, layer, file_name, on_complete):
+        # the lock keeps other projects from resuming the same .part file at the same time
+        with self.tile_cache.lock(self.county, layer, file_name):
+            file_path, entry = self.tile_cache.get(self.county, layer, file_name)
+            if file_path is None:
+                file_path = self.tile_cache.path(self.county, layer, file_name)
+                start_time = time.time()
+                entry = download_file(self.session, url, file_path)
+                print('url:', url, 'status code:', entry['status_code'], 'in', round(time.time() - start_time, 1),
+                      's')
+                if entry['status_code'] != 200:
+                    return entry
+                self.tile_cache.add(file_path, entry)
+        self.record(layer + '/' + file_name, entry)
+        if on_complete is not None:
+            on_complete(file_path)
+        return entry
+
+    def record(self, tile_key, entry):
+        with self._manifest_lock:
+            if self.manifest.get(tile_key) != entry:
+                self.manifest[tile_key] = entry
+                self.save_manifest()
+
+    def save_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        temp_path = self.manifest_path + '.part'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    def close(self):
+        """
+        Waits for all downloads and their callbacks. An exception raised in a callback is raised here.
+        :return: List of the manifest entries of the submitted tiles, in submission order.
+        """
+        try:
+            return [future.result() for future in self._futures]
+        finally:
+            self._executor.shutdown()
+            self.session.close()
+            self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
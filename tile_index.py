@@ -0,0 +1,68 @@
+import os
+import pickle
+import hashlib
+
+TILE_INDEX_FOLDER = os.path.join(os.getcwd(), 'tile_index')
+TILE_INDEX_VERSION = 1
+
+
+def tile_key(file_name, data_type):
+    """
+    Tile id (easting_northing) in the name of a Hamburg source file: characters 5 to 13 for GML files, 7 to 15 for the
+    DSM and DTM files.
+    """
+    return file_name[5:13] if data_type == 'GML' else file_name[7:15]
+
+
+class TileIndex:
+    """
+    Persistent index of the files in a source folder (e.g. the Hamburg shared drive), mapping tile ids to file names.
+    The index is pickled into TILE_INDEX_FOLDER and rebuilt only when the modification time of the source folder
+    changes, so a lookup needs a single stat of the folder instead of a listdir.
+
+    tile_index = TileIndex(source_folder)
+    file_names = tile_index.lookup('GML', '565_5935')
+    """
+
+    def __init__(self, source_folder, index_folder=TILE_INDEX_FOLDER):
+        self.source_folder = source_folder
+        folder_hash = hashlib.sha1(os.path.abspath(source_folder).encode('utf8')).hexdigest()[:16]
+        self.index_path = os.path.join(index_folder, folder_hash + '.pickle')
+        self.keys = self.load()
+
+    def load(self):
+        mtime = os.stat(self.source_folder).st_mtime_ns
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+            if index['version'] == TILE_INDEX_VERSION and index['source_folder'] == self.source_folder and \
+                    index['mtime'] == mtime:
+                return index['keys']
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            pass
+        return self.build(mtime)
+
+    def build(self, mtime):
+        print('indexing', self.source_folder)
+        keys = {'GML': {}, 'surface': {}}
+        with os.scandir(self.source_folder) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                keys['GML'].setdefault(tile_key(entry.name, 'GML'), []).append(entry.name)
+                keys['surface'].setdefault(tile_key(entry.name, 'DSM'), []).append(entry.name)
+        index = {'version': TILE_INDEX_VERSION, 'source_folder': self.source_folder, 'mtime': mtime, 'keys': keys}
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = self.index_path + '.part'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.index_path)
+        return keys
+
+    def lookup(self, data_type, zip_file_addon):
+        """
+        :param data_type: The type of data (GML, DSM or DTM).
+        :param zip_file_addon: Tile id in the form easting_northing.
+        :return: List of the names of the files of the tile in the source folder.
+        """
+        return self.keys['GML' if data_type == 'GML' else 'surface'].get(zip_file_addon, [])
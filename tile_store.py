@@ -0,0 +1,410 @@
+import io
+import os
+import numpy as np
+import laspy
+from concurrent.futures import ProcessPoolExecutor
+
+TILE_MAGIC = b'LTTS'
+TILE_VERSION = 2
+TILE_EXTENSION = '.tile'
+TILE_STORE_FOLDER = 'TileStore'
+
+# 80 byte header of version 1 tiles
+TILE_HEADER_V1_DTYPE = np.dtype([('magic', 'S4'),
+                                 ('version', '<u4'),
+                                 ('count', '<u8'),
+                                 ('origin', '<f8', (2,)),
+                                 ('min', '<f8', (3,)),
+                                 ('max', '<f8', (3,))])
+# 112 byte header followed by three float32 columns: x and y relative to the origin, z absolute. clip is the
+# [min_x, min_y, max_x, max_y] box the points were cut to when the tile was ingested, NaN for complete tiles.
+TILE_HEADER_DTYPE = np.dtype(TILE_HEADER_V1_DTYPE.descr + [('clip', '<f8', (4,))])
+
+
+class TileStoreError(Exception):
+    pass
+
+
+def read_tile_header(store_fp):
+    """
+    Reads the header of a tile store file, of the current version or version 1.
+    :return: The header as a numpy record.
+    """
+    header = np.fromfile(store_fp, dtype=TILE_HEADER_V1_DTYPE, count=1)
+    if len(header) == 0 or header['magic'][0] != TILE_MAGIC:
+        raise TileStoreError('%s is not a tile store file.' % store_fp)
+    version = header['version'][0]
+    if version == TILE_VERSION:
+        header = np.fromfile(store_fp, dtype=TILE_HEADER_DTYPE, count=1)
+    elif version != 1:
+        raise TileStoreError('%s has tile store version %s, expected %s.' % (store_fp, version, TILE_VERSION))
+    return header[0]
+
+
+def new_tile_header(count, clip=None):
+    header = np.zeros(1, dtype=TILE_HEADER_DTYPE)
+    header['magic'] = TILE_MAGIC
+    header['version'] = TILE_VERSION
+    header['count'] = count
+    header['clip'] = np.nan if clip is None else clip
+    return header
+
+
+def tile_covers(store_fp, bbox):
+    """
+    Checks whether a tile store file holds all points of its source tile inside bbox, so the tile does not have to
+    be ingested again. Complete tiles cover any bbox; a clipped tile only covers boxes inside its clip box, and
+    version 1 tiles, which do not record whether they were clipped, cover nothing.
+    :param store_fp: Path of the tile store file.
+    :param bbox: [min_x, min_y, max_x, max_y], or None for the whole tile.
+    :return: True if the tile covers bbox, False if it is missing, unreadable or does not cover it.
+    """
+    try:
+        header = read_tile_header(store_fp)
+    except (OSError, TileStoreError):
+        return False
+    if header['version'] == 1:
+        return False
+    clip = header['clip']
+    if np.isnan(clip).any():
+        return True
+    if bbox is None:
+        return False
+    return clip[0] <= bbox[0] and clip[1] <= bbox[1] and clip[2] >= bbox[2] and clip[3] >= bbox[3]
+
+
+class PointTile:
+    """
+    A point tile opened from the binary tile store. The x, y and z columns are read-only memory maps, nothing is
+    loaded before it is used. x and y are stored as float32 offsets to the tile origin, which keeps centimetre
+    precision for UTM coordinates.
+    """
+
+    def __init__(self, store_fp):
+        self.store_fp = store_fp
+        header = read_tile_header(store_fp)
+        self.version = int(header['version'])
+        self.count = int(header['count'])
+        self.origin = header['origin'].copy()
+        self.min = header['min'].copy()
+        self.max = header['max'].copy()
+        # None for complete tiles; version 1 tiles do not record it
+        self.clip = header['clip'].copy() if self.version > 1 and not np.isnan(header['clip']).any() else None
+        if self.count:
+            columns = np.memmap(store_fp, dtype='<f4', mode='r', offset=header.dtype.itemsize,
+                                shape=(3, self.count))
+        else:
+            columns = np.zeros((3, 0), dtype='<f4')
+        self.x_offset = columns[0]
+        self.y_offset = columns[1]
+        self.z = columns[2]
+
+    def __len__(self):
+        return self.count
+
+    def bbox_intersects(self, min_x, min_y, max_x, max_y):
+        return not (self.max[0] < min_x or self.min[0] > max_x or self.max[1] < min_y or self.min[1] > max_y)
+
+    def points(self, start=0, stop=None):
+        """
+        Materialises the rows start:stop as an (n, 3) float64 array of absolute coordinates.
+        """
+        points = np.empty((len(self.z[start:stop]), 3), dtype=np.float64)
+        points[:, 0] = self.x_offset[start:stop]
+        points[:, 0] += self.origin[0]
+        points[:, 1] = self.y_offset[start:stop]
+        points[:, 1] += self.origin[1]
+        points[:, 2] = self.z[start:stop]
+        return points
+
+    def chunks(self, chunk_size=1000000):
+        for start in range(0, self.count, chunk_size):
+            yield start, self.points(start, start + chunk_size)
+
+
+def normalise_easting(x):
+    """
+    Some DTM tiles prefix the easting with the UTM zone (e.g. 32343000.0 instead of 343000.0). The zone digits are
+    cut off here, once, instead of for every point at read time.
+    """
+    eight_digits = (x >= 1e7) & (x < 1e8)
+    if eight_digits.any():
+        x = np.where(eight_digits, x - np.floor(x / 1e6) * 1e6, x)
+    return x
+
+
+def write_tile(store_fp, x, y, z, clip=None):
+    """
+    Writes x, y, z columns into a tile store file. The file is written next to its final location and renamed, so
+    readers never see half written tiles.
+    :param store_fp: Path of the tile store file.
+    :param x: Easting of the points.
+    :param y: Northing of the points.
+    :param z: Height of the points.
+    :param clip: [min_x, min_y, max_x, max_y] the points were cut to, None if the tile is complete.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+    header = new_tile_header(len(x), clip)
+    if len(x):
+        header['origin'] = [np.floor(x.min()), np.floor(y.min())]
+        header['min'] = [x.min(), y.min(), z.min()]
+        header['max'] = [x.max(), y.max(), z.max()]
+
+    os.makedirs(os.path.dirname(store_fp), exist_ok=True)
+    temp_fp = store_fp + '.part'
+    with open(temp_fp, 'wb') as f:
+        header.tofile(f)
+        (x - header['origin'][0][0]).astype('<f4').tofile(f)
+        (y - header['origin'][0][1]).astype('<f4').tofile(f)
+        z.astype('<f4').tofile(f)
+    os.replace(temp_fp, store_fp)
+
+
+def count_lines(text_fp, chunk_size=16 * 1024 * 1024):
+    """
+    :return: The number of lines of a text file, blank lines included.
+    """
+    line_count = 0
+    last_byte = b'\n'
+    with open(text_fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            line_count += chunk.count(b'\n')
+            last_byte = chunk[-1:]
+    return line_count + (last_byte != b'\n')
+
+
+def load_xyz_rows(source, column_count, name):
+    """
+    Parses x y z rows with np.loadtxt, which skips blank lines and fails on a row it cannot read, unlike the sep mode
+    of np.fromfile and np.fromstring that stops at the first bad token.
+    :param source: Path or text file object.
+    :param column_count: Number of columns every row must have.
+    :param name: Name of the source used in the error message.
+    :return: (n, column_count) float64 array.
+    """
+    try:
+        values = np.loadtxt(source, dtype=np.float64, ndmin=2)
+    except ValueError as error:
+        raise TileStoreError('%s could not be read: %s' % (name, error))
+    if len(values) and values.shape[1] != column_count:
+        raise TileStoreError('%s does not have %s columns in every line.' % (name, column_count))
+    return values
+
+
+def read_xyz_text(text_fp):
+    """
+    Reads a whitespace (or comma) separated x y z text tile into an (n, 3) float64 array. Additional columns are
+    ignored. The values are parsed with np.fromfile; if their number does not match the lines of the file (a header
+    line, a damaged row, blank lines), the file is parsed again with np.loadtxt, which raises on bad rows.
+    """
+    with open(text_fp, 'r', encoding='utf8') as f:
+        first_line = f.readline()
+    if not first_line.strip():
+        return np.zeros((0, 3))
+    if ',' in first_line:
+        values = np.loadtxt(text_fp, delimiter=',', usecols=(0, 1, 2), ndmin=2)
+        return values
+    column_count = len(first_line.split())
+    try:
+        values = np.fromfile(text_fp, dtype=np.float64, sep=' ')
+    except ValueError:
+        # newer numpy versions raise on unmatched data instead of warning
+        values = None
+    if values is None or len(values) != count_lines(text_fp) * column_count:
+        return load_xyz_rows(text_fp, column_count, text_fp)[:, :3]
+    return values.reshape(-1, column_count)[:, :3]
+
+
+def read_xyz_stream(stream, bbox=None, block_size=16 * 1024 * 1024):
+    """
+    Reads an x y z text tile from a binary file object block by block, e.g. straight from a gzip stream or a zip
+    member, and keeps only the points inside bbox. Eastings are normalised before filtering. A header line or a damaged
+    row raises a TileStoreError instead of ending the tile early.
+    :param stream: Binary file object with whitespace (or comma) separated lines.
+    :param bbox: Optional [min_x, min_y, max_x, max_y].
+    :param block_size: Number of bytes parsed at once.
+    :return: (n, 3) float64 array of the points kept.
+    """
+    column_count = None
+    selected = [np.zeros((0, 3))]
+    rest = b''
+    while True:
+        block = stream.read(block_size)
+        data = rest + block
+        if block:
+            cut = data.rfind(b'\n') + 1
+            data, rest = data[:cut], data[cut:]
+        else:
+            rest = b''
+        text = data.replace(b',', b' ').decode('utf8').strip()
+        if text:
+            if column_count is None:
+                column_count = len(text.split('\n', 1)[0].split())
+            try:
+                values = np.fromstring(text, dtype=np.float64, sep=' ')
+            except ValueError:
+                # newer numpy versions raise on unmatched data instead of warning
+                values = None
+            # np.fromstring stops at the first bad token, so the values are checked against the lines of the block
+            if values is None or len(values) != (text.count('\n') + 1) * column_count:
+                values = load_xyz_rows(io.StringIO(text), column_count, 'the stream')
+            points = values.reshape(-1, column_count)[:, :3].copy()
+            points[:, 0] = normalise_easting(points[:, 0])
+            if bbox is not None:
+                points = points[(points[:, 0] >= bbox[0]) & (points[:, 1] >= bbox[1]) &
+                                (points[:, 0] <= bbox[2]) & (points[:, 1] <= bbox[3])]
+            selected.append(points)
+        if not block:
+            break
+    return np.concatenate(selected)
+
+
+def ingest_points(points, store_fp, source, clip=None):
+    write_tile(store_fp, points[:, 0], points[:, 1], points[:, 2], clip)
+    print('ingested', source, 'into the tile store,', len(points), 'points.')
+    return store_fp
+
+
+def ingest_text_tile(text_fp, store_fp):
+    points = read_xyz_text(text_fp)
+    write_tile(store_fp, normalise_easting(points[:, 0]), points[:, 1], points[:, 2])
+    print('ingested', text_fp, 'into the tile store,', len(points), 'points.')
+    return store_fp
+
+
+def ingest_las_tile(las_fp, store_fp, chunk_size=2000000, remove_source=False):
+    """
+    Decodes a LAS or LAZ point cloud into a tile store file. The points are read in chunks and written straight into
+    the columns of the store file, so a tile is never held in memory as a whole. LAZ needs a laspy backend (lazrs).
+    :param las_fp: Path of the .las or .laz file.
+    :param store_fp: Path of the tile store file.
+    :param chunk_size: Number of points decoded at once.
+    :param remove_source: Delete the point cloud file once the tile is stored.
+    :return store_fp: Path of the tile store file.
+    """
+    os.makedirs(os.path.dirname(store_fp), exist_ok=True)
+    temp_fp = store_fp + '.part'
+    with laspy.open(las_fp) as las_file:
+        count = int(las_file.header.point_count)
+        header = new_tile_header(count)
+        with open(temp_fp, 'wb') as f:
+            header.tofile(f)
+            f.truncate(TILE_HEADER_DTYPE.itemsize + 3 * 4 * count)
+        if count:
+            origin = np.floor(normalise_easting(np.asarray(las_file.header.mins[:2], dtype=np.float64)))
+            header['origin'] = origin
+            columns = np.memmap(temp_fp, dtype='<f4', mode='r+', offset=TILE_HEADER_DTYPE.itemsize,
+                                shape=(3, count))
+            minimum = np.full(3, np.inf)
+            maximum = np.full(3, -np.inf)
+            start = 0
+            for points in las_file.chunk_iterator(chunk_size):
+                x = normalise_easting(np.asarray(points.x, dtype=np.float64))
+                y = np.asarray(points.y, dtype=np.float64)
+                z = np.asarray(points.z, dtype=np.float64)
+                stop = start + len(x)
+                columns[0, start:stop] = x - origin[0]
+                columns[1, start:stop] = y - origin[1]
+                columns[2, start:stop] = z
+                minimum = np.minimum(minimum, [x.min(), y.min(), z.min()])
+                maximum = np.maximum(maximum, [x.max(), y.max(), z.max()])
+                start = stop
+            columns.flush()
+            del columns
+            if start != count:
+                os.remove(temp_fp)
+                raise TileStoreError('%s has %s points, its header says %s.' % (las_fp, start, count))
+            header['min'] = minimum
+            header['max'] = maximum
+    with open(temp_fp, 'r+b') as f:
+        header.tofile(f)
+    os.replace(temp_fp, store_fp)
+    print('ingested', las_fp, 'into the tile store,', count, 'points.')
+    if remove_source:
+        os.remove(las_fp)
+    return store_fp
+
+
+class TileIngestPool:
+    """
+    Converts point cloud tiles into the tile store in worker processes, so several tiles are decoded at the same time
+    and a tile can be handed over as soon as it is downloaded.
+
+    ingest_pool = TileIngestPool(project_folder)
+    ingest_pool.submit(laz_fp, 'DSM', tile_name)
+    ingest_pool.close()
+    """
+
+    def __init__(self, project_folder, workers=None):
+        """
+        :param project_folder: Directory where the project is stored.
+        :param workers: Number of worker processes, the number of CPUs by default.
+        """
+        self.project_folder = project_folder
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._futures = []
+
+    def submit(self, las_fp, data_type, tile_name, remove_source=True):
+        store_fp = tile_store_path(self.project_folder, data_type, tile_name)
+        future = self._executor.submit(ingest_las_tile, las_fp, store_fp, remove_source=remove_source)
+        self._futures.append(future)
+        return future
+
+    def close(self):
+        """
+        Waits for all conversions. An exception raised while converting a tile is raised here.
+        :return: The tile store paths of the converted tiles.
+        """
+        try:
+            return [future.result() for future in self._futures]
+        finally:
+            self._executor.shutdown()
+            self._futures = []
+
+
+def tile_store_folder(project_folder, data_type):
+    return os.path.join(project_folder, 'GeospatialData', TILE_STORE_FOLDER, data_type)
+
+
+def tile_store_path(project_folder, data_type, tile_name):
+    return os.path.join(tile_store_folder(project_folder, data_type), tile_name + TILE_EXTENSION)
+
+
+def ingest_layer(project_folder, data_type):
+    """
+    Converts the downloaded text tiles of a layer (e.g. GeospatialData/DTM) into the binary tile store
+    (GeospatialData/TileStore/DTM). A tile is converted again only when its text file is newer than its store file.
+    Tiles that were decoded straight into the store (point clouds) have no text file and are added after the others.
+    :param project_folder: Directory where the project is stored.
+    :param data_type: The type of data (DTM or DSM).
+    :return store_paths: The store files of the layer, text tiles first in their listing order.
+    """
+    layer_folder = os.path.join(project_folder, 'GeospatialData', data_type)
+    store_paths = []
+    if os.path.isdir(layer_folder):
+        for file_name in os.listdir(layer_folder):
+            text_fp = os.path.join(layer_folder, file_name)
+            if not os.path.isfile(text_fp):
+                continue
+            store_fp = tile_store_path(project_folder, data_type, os.path.splitext(file_name)[0])
+            if not os.path.exists(store_fp) or os.path.getmtime(store_fp) < os.path.getmtime(text_fp):
+                ingest_text_tile(text_fp, store_fp)
+            store_paths.append(store_fp)
+    store_folder = tile_store_folder(project_folder, data_type)
+    if os.path.isdir(store_folder):
+        text_tiles = set(store_paths)
+        for file_name in sorted(os.listdir(store_folder)):
+            store_fp = os.path.join(store_folder, file_name)
+            if file_name.endswith(TILE_EXTENSION) and store_fp not in text_tiles:
+                store_paths.append(store_fp)
+    return store_paths
+
+
+def open_layer(project_folder, data_type):
+    """
+    Ingests the layer if needed and opens all of its tiles.
+    :return: List of PointTile objects.
+    """
+    return [PointTile(store_fp) for store_fp in ingest_layer(project_folder, data_type)]
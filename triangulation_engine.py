@@ -0,0 +1,230 @@
+import numpy as np
+
+# surfaces tilted less than this are projected on the XY plane, the others on the XZ plane (see Surface.projecting)
+PROJECTION_TILT = 80.0
+# relative tolerance below which two edges are treated as parallel; such surfaces take the per-surface path
+PARALLEL_TOLERANCE = 1e-9
+
+FALLBACK = 0
+TRIANGLE = 3
+TETRAGON = 4
+
+
+def polygon_buffer(polygons):
+    """
+    Packs the surface polygons of a building into one flat vertex buffer.
+    :param polygons: List of polygons in the form [[x1,y1,z1],[x2,y2,z2],...].
+    :return points, offsets: (n, 3) float64 array of all vertices and the start of every polygon in it (plus the end).
+    None, None if not every vertex has three coordinates.
+    """
+    counts = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+    offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    try:
+        points = np.array([vertex for polygon in polygons for vertex in polygon], dtype=np.float64).reshape(-1, 3)
+    except (ValueError, TypeError):
+        return None, None
+    if len(points) != offsets[-1]:
+        return None, None
+    return points, offsets
+
+
+def surface_tilts(points, offsets):
+    """
+    Tilt of every surface in degrees, computed for all surfaces at once. Like Surface.parameter_form, the normal is
+    the cross product of the first two edges of the polygon; downward normals get a tilt of 0 like in
+    Surface.angle_calculation_deg. Degenerate surfaces get NaN.
+    """
+    counts = np.diff(offsets)
+    tilts = np.full(len(counts), np.nan)
+    rows = np.nonzero(counts >= 3)[0]
+    if len(rows) == 0:
+        return tilts
+    start = offsets[rows]
+    dir_vec_ab = points[start + 1] - points[start]
+    dir_vec_bc = points[start + 2] - points[start + 1]
+    perpendicular = np.cross(dir_vec_ab, dir_vec_bc)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_perpendicular = 1.0 / np.sqrt(perpendicular[:, 0] ** 2 + perpendicular[:, 1] ** 2 +
+                                           perpendicular[:, 2] ** 2)[:, None] * perpendicular
+        tilt_f = np.degrees(np.arccos(norm_perpendicular[:, 2]))
+    tilt_f[tilt_f > 90] = 0.0
+    tilts[rows] = tilt_f
+    return tilts
+
+
+def projected_buffer(points, offsets, tilts):
+    """
+    Projects every surface on the XY plane if its tilt is below PROJECTION_TILT, on the XZ plane otherwise.
+    :return: (n, 2) array of the projected vertices.
+    """
+    flat = np.repeat(tilts < PROJECTION_TILT, np.diff(offsets))
+    return np.where(flat[:, None], points[:, [0, 1]], points[:, [0, 2]])
+
+
+def _turns(projected, corners):
+    """
+    z component of the cross product of the edges into and out of every corner, plus the edge length product.
+    :param corners: (m, k) array of vertex indices of m closed polygons without the repeated last vertex.
+    """
+    before = projected[np.roll(corners, 1, axis=1)]
+    here = projected[corners]
+    after = projected[np.roll(corners, -1, axis=1)]
+    edge_in = here - before
+    edge_out = after - here
+    turn = edge_in[..., 0] * edge_out[..., 1] - edge_in[..., 1] * edge_out[..., 0]
+    scale = np.hypot(edge_in[..., 0], edge_in[..., 1]) * np.hypot(edge_out[..., 0], edge_out[..., 1])
+    return turn, scale
+
+
+def classify_surfaces(points, offsets, projected):
+    """
+    Finds the surfaces that can be triangulated by index arithmetic: closed triangles with a non-degenerate
+    projection (4 vertices) and closed, strictly convex tetragons (5 vertices). Their projections are valid polygons,
+    so they are triangulated exactly as the per-surface path would do it. Everything else is marked FALLBACK.
+    :return kinds: Array with TRIANGLE, TETRAGON or FALLBACK for every surface.
+    """
+    counts = np.diff(offsets)
+    kinds = np.full(len(counts), FALLBACK, dtype=np.int8)
+    for kind, count in ((TRIANGLE, 4), (TETRAGON, 5)):
+        rows = np.nonzero(counts == count)[0]
+        if len(rows) == 0:
+            continue
+        start = offsets[rows]
+        closed = np.all(points[start] == points[start + count - 1], axis=1)
+        corners = start[:, None] + np.arange(count - 1)
+        turn, scale = _turns(projected, corners)
+        clear = np.abs(turn) > PARALLEL_TOLERANCE * scale
+        convex = (np.all(turn > 0, axis=1) | np.all(turn < 0, axis=1)) & np.all(clear, axis=1)
+        kinds[rows[closed & convex]] = kind
+    return kinds
+
+
+def fast_triangle_indices(offsets, kinds):
+    """
+    Vertex indices of the triangles of the TRIANGLE and TETRAGON surfaces, in surface order. A triangle is the
+    surface itself, a tetragon [a, b, c, d, a] gives [a, b, c, a] and [c, d, a, c] like triangulate_tetragon.
+    :return: (m, 4) array of vertex indices.
+    """
+    start = offsets[:-1]
+    triangle_count = np.where(kinds == TRIANGLE, 1, np.where(kinds == TETRAGON, 2, 0))
+    surface_rows = np.repeat(np.arange(len(kinds)), triangle_count)
+    second = np.zeros(len(surface_rows), dtype=bool)
+    second[1:] = surface_rows[1:] == surface_rows[:-1]
+    first_vertex = start[surface_rows] + np.where(second, 2, 0)
+    return first_vertex[:, None] + np.array([0, 1, 2, 0])
+
+
+def triangulate_polygons(polygons, fallback):
+    """
+    Triangulates the surface polygons of a building in one batch. Tilt, projection and validity are computed for
+    all surfaces at once with numpy, triangles and convex tetragons are split by index arithmetic, and only the
+    remaining surfaces (polygons with more than 5 points, concave or degenerate ones) go through the per-surface
+    fallback. The result is the same, in the same order, as calling the fallback for every surface.
+    :param polygons: List of polygons in the form [[x1,y1,z1],[x2,y2,z2],...].
+    :param fallback: Function polygon -> (list of triangles, faulty flag), the per-surface triangulation.
+    :return triangles, faulty_positions: List of the triangles of all surfaces and the positions of the faulty ones.
+    """
+    points, offsets = polygon_buffer(polygons)
+    if points is None:
+        kinds = np.full(len(polygons), FALLBACK, dtype=np.int8)
+        fast_triangles = []
+    else:
+        tilts = surface_tilts(points, offsets)
+        kinds = classify_surfaces(points, offsets, projected_buffer(points, offsets, tilts))
+        fast_triangles = points[fast_triangle_indices(offsets, kinds)].tolist()
+
+    triangles = []
+    faulty_positions = []
+    next_fast = 0
+    for position, kind in enumerate(kinds):
+        if kind == FALLBACK:
+            surface_triangles, faulty = fallback(polygons[position])
+            triangles.extend(surface_triangles)
+            if faulty:
+                faulty_positions.append(position)
+        else:
+            step = 1 if kind == TRIANGLE else 2
+            triangles.extend(fast_triangles[next_fast:next_fast + step])
+            next_fast += step
+    return triangles, faulty_positions
+
+
+def newell_normal(points):
+    """
+    Normal of a (possibly non-convex) polygon by Newell's method; unlike the cross product of two edges it does not
+    depend on which vertices are picked.
+    """
+    following = np.roll(points, -1, axis=0)
+    return np.array([np.sum((points[:, 1] - following[:, 1]) * (points[:, 2] + following[:, 2])),
+                     np.sum((points[:, 2] - following[:, 2]) * (points[:, 0] + following[:, 0])),
+                     np.sum((points[:, 0] - following[:, 0]) * (points[:, 1] + following[:, 1]))])
+
+
+def ear_clipping(ring):
+    """
+    Triangulates a simple 2D polygon by ear clipping. A vertex is an ear if it is convex and no other vertex of the
+    polygon lies in the triangle it forms with its neighbours; ears are cut off one after another until a triangle
+    is left. Should the polygon not be simple (self-touching or degenerate rings), the most convex vertex is cut off
+    when no ear is left, so a ring of n vertices always gives n - 2 triangles.
+    :param ring: (n, 2) array of the polygon vertices, without the repeated first vertex.
+    :return: List of (i, j, k) vertex index triangles, in the orientation of the ring.
+    """
+    count = len(ring)
+    if count < 3:
+        return []
+    x = ring[:, 0]
+    y = ring[:, 1]
+    orientation = 1.0 if np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y) >= 0 else -1.0
+    remaining = list(range(count))
+    triangles = []
+    while len(remaining) > 3:
+        size = len(remaining)
+        candidates = np.array(remaining)
+        before = ring[np.roll(candidates, 1)]
+        here = ring[candidates]
+        after = ring[np.roll(candidates, -1)]
+        turns = orientation * ((here[:, 0] - before[:, 0]) * (after[:, 1] - here[:, 1]) -
+                               (here[:, 1] - before[:, 1]) * (after[:, 0] - here[:, 0]))
+        reflex = candidates[turns <= 0]
+        ear = None
+        for position in np.nonzero(turns > 0)[0]:
+            a, b, c = before[position], here[position], after[position]
+            others = reflex[(reflex != candidates[position - 1]) & (reflex != candidates[(position + 1) % size])]
+            if len(others):
+                p = ring[others]
+                coincident = np.all(p == a, axis=1) | np.all(p == b, axis=1) | np.all(p == c, axis=1)
+                inside = ((orientation * ((b[0] - a[0]) * (p[:, 1] - a[1]) - (b[1] - a[1]) * (p[:, 0] - a[0])) >= 0) &
+                          (orientation * ((c[0] - b[0]) * (p[:, 1] - b[1]) - (c[1] - b[1]) * (p[:, 0] - b[0])) >= 0) &
+                          (orientation * ((a[0] - c[0]) * (p[:, 1] - c[1]) - (a[1] - c[1]) * (p[:, 0] - c[0])) >= 0))
+                if np.any(inside & ~coincident):
+                    continue
+            ear = position
+            break
+        if ear is None:
+            ear = int(np.argmax(turns))
+        triangles.append((remaining[ear - 1], remaining[ear], remaining[(ear + 1) % size]))
+        del remaining[ear]
+    triangles.append(tuple(remaining))
+    return triangles
+
+
+def ear_clipping_triangles(polygon_a):
+    """
+    Triangulates a planar 3D polygon with ear clipping. The polygon is projected on the coordinate plane its normal
+    is most perpendicular to, so walls, roofs and grounds all keep their shape in the projection.
+    :param polygon_a: polygon array in the form [[x1,y1,z1],[x2,y2,z2],...], closed or not.
+    :return: List of closed triangles [[x1,y1,z1],[x2,y2,z2],[x3,y3,z3],[x1,y1,z1]] made of the polygon vertices.
+    """
+    ring = polygon_a[:-1] if len(polygon_a) > 1 and list(polygon_a[0]) == list(polygon_a[-1]) else polygon_a
+    # consecutive repeated vertices would give zero area triangles
+    vertices = [position for position in range(len(ring)) if list(ring[position]) != list(ring[position - 1])]
+    if len(vertices) < 3:
+        return []
+    points = np.array([ring[position] for position in vertices], dtype=np.float64)
+    dominant_axis = int(np.argmax(np.abs(newell_normal(points - points.mean(axis=0)))))
+    projection = [axis for axis in range(3) if axis != dominant_axis]
+    triangles = []
+    for i, j, k in ear_clipping(points[:, projection]):
+        triangles.append([ring[vertices[i]], ring[vertices[j]], ring[vertices[k]], ring[vertices[i]]])
+    return triangles